@@ -0,0 +1,82 @@
+import os
+import time
+import json
+import argparse
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForSequenceClassification, DataCollatorWithPadding
+from transformers.trainer_pt_utils import LengthGroupedSampler
+from main import load_data, load_instruction, tokenize_dataset, TokenBudgetBatchSampler
+
+def get_args():
+    parser = argparse.ArgumentParser(description="compare padding ratio and training throughput of the batching strategies")
+    parser.add_argument("--model_name", type=str, help="pretrained model name", required=True)
+    parser.add_argument("--dataset_dir", type=str, help="data dir", required=True)
+    parser.add_argument("--batch_size", type=int, help="batch size", default=16)
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--max_tokens", type=int, help="token budget of the token_budget strategy, defaults to batch_size x max_length", default=None)
+    parser.add_argument("--num_batches", type=int, help="number of timed training steps per strategy, 0 only reports padding", default=20)
+    parser.add_argument("--num_labels", type=int, help="number of label", default=2)
+    parser.add_argument("--output", type=str, help="json report path", default=None)
+    args = parser.parse_args()
+    return args
+
+def make_batches(strategy, lengths, batch_size, max_tokens, seed=42):
+    if strategy == "grouped":
+        indices = list(LengthGroupedSampler(batch_size, lengths=lengths, generator=torch.Generator().manual_seed(seed)))
+    elif strategy == "token_budget":
+        return list(TokenBudgetBatchSampler(lengths, max_tokens, seed=seed))
+    else:
+        indices = np.random.RandomState(seed).permutation(len(lengths)).tolist()
+    return [indices[i:i + batch_size] for i in range(0, len(indices), batch_size)]
+
+def padding_ratio(batches, lengths, pad_to=None):
+    real = sum(lengths[i] for batch in batches for i in batch)
+    padded = sum((pad_to or max(lengths[i] for i in batch)) * len(batch) for batch in batches)
+    return 1 - real / padded
+
+def train_throughput(model, dataset, batches, collator, num_batches):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    model.train()
+    samples = 0
+    start = time.perf_counter()
+    for b in np.random.RandomState(0).permutation(len(batches))[:num_batches]:
+        batch = batches[b]
+        features = collator([{k: dataset[i][k] for k in ("input_ids", "attention_mask", "labels")} for i in batch])
+        loss = model(**features).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        samples += len(batch)
+    return samples / (time.perf_counter() - start)
+
+def main():
+    args = get_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(args.model_name, num_labels=args.num_labels)
+    max_tokens = args.max_tokens or args.batch_size * args.max_length
+
+    train_dataset, _, _ = load_data(args.dataset_dir)
+    token_cache_dir = os.path.join(args.dataset_dir, "token_cache")
+    train_dataset = tokenize_dataset(train_dataset, tokenizer, token_cache_dir, load_instruction(args.dataset_dir), args.max_length)
+    lengths = train_dataset["length"]
+    collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    padded_collator = DataCollatorWithPadding(tokenizer=tokenizer, padding="max_length", max_length=args.max_length)
+
+    report = {}
+    for strategy in ["max_length", "dynamic", "grouped", "token_budget"]:
+        batches = make_batches(strategy, lengths, args.batch_size, max_tokens)
+        pad_to = args.max_length if strategy == "max_length" else None
+        result = {"batches": len(batches), "padding_ratio": padding_ratio(batches, lengths, pad_to)}
+        if args.num_batches:
+            result["samples_per_second"] = train_throughput(model, train_dataset, batches,
+                                                            padded_collator if pad_to else collator, args.num_batches)
+        report[strategy] = result
+        print(f"{strategy}: {result}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import json
+import time
+import argparse
+import torch
+from transformers import AutoTokenizer, DataCollatorWithPadding
+from main import (load_split, load_instruction, load_saved_model, model_num_labels, tokenize_dataset, streaming_evaluate,
+                  WindowCollator, WindowPoolingModel, PREDICTIONS_SUFFIX, EVAL_REPORT_SUFFIX)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="evaluate a saved model or checkpoint on a split of a preprocessed dataset")
+    parser.add_argument("--model_dir", type=str, help="final_model or checkpoint-<step> dir written by main.py", required=True)
+    parser.add_argument("--dataset_dir", type=str, help="preprocessed dataset dir", required=True)
+    parser.add_argument("--split", type=str, help="split to evaluate, <split>.tsv or <split>.parquet of dataset_dir", default="test")
+    parser.add_argument("--output_dir", type=str, help="dir of <split>_predictions.parquet and <split>_metrics.json, defaults to model_dir", default=None)
+    parser.add_argument("--batch_size", type=int, help="max flows per batch", default=32)
+    parser.add_argument("--max_tokens", type=int, help="cap batches by padded token count as well", default=None)
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--max_windows", type=int, help="packet windows kept per flow by window pooling models, defaults to the saved one", default=None)
+    parser.add_argument("--num_proc", type=int, help="number of tokenization processes", default=os.cpu_count())
+    parser.add_argument("--token_cache_dir", type=str, help="tokenized dataset cache dir, defaults to <dataset_dir>/token_cache", default=None)
+    parser.add_argument("--no_predictions", action="store_true", help="only compute the metrics")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = get_args()
+    output_dir = args.output_dir or args.model_dir
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_saved_model(args.model_dir)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+
+    dataset = load_split(args.dataset_dir, args.split, with_features=getattr(model, "num_features", 0) > 0)
+    token_cache_dir = args.token_cache_dir or os.path.join(args.dataset_dir, "token_cache")
+    windowed = isinstance(model, WindowPoolingModel)
+    dataset = tokenize_dataset(dataset, tokenizer, token_cache_dir, load_instruction(args.dataset_dir), args.max_length, args.num_proc,
+                               max_windows=(args.max_windows or model.max_windows) if windowed else 0)
+    data_collator = WindowCollator(tokenizer) if windowed else DataCollatorWithPadding(tokenizer=tokenizer)
+    print(f"{args.split} size: {len(dataset)}")
+
+    predictions_path = None if args.no_predictions else os.path.join(output_dir, args.split + PREDICTIONS_SUFFIX)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    start = time.perf_counter()
+    result = streaming_evaluate(model, dataset, data_collator, model_num_labels(model),
+                                args.batch_size, args.max_tokens, predictions_path, device)
+    result["seconds"] = time.perf_counter() - start
+    print(f"{args.split} result: {result}")
+
+    report_path = os.path.join(output_dir, args.split + EVAL_REPORT_SUFFIX)
+    with open(report_path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"metrics are saved in: {report_path}")
+    if predictions_path:
+        print(f"predictions are saved in: {predictions_path}")
+
+if __name__ == "__main__":
+    main()
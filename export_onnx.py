@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from torch import nn
+from transformers import AutoTokenizer
+from main import (load_split, load_instruction, load_saved_model, model_num_labels, tokenize_dataset, compute_metrics,
+                  TokenBudgetBatchSampler, WindowPoolingModel)
+from predict import latency_report
+
+ONNX_DIR = "onnx"
+ONNX_FP32_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+ONNX_REPORT_FILE = "onnx_report.json"
+
+def get_args():
+    parser = argparse.ArgumentParser(description="export a saved model to ONNX, quantize it to int8 and compare the runtimes on a split")
+    parser.add_argument("--model_dir", type=str, help="final_model or checkpoint-<step> dir written by main.py", required=True)
+    parser.add_argument("--dataset_dir", type=str, help="preprocessed dataset dir", required=True)
+    parser.add_argument("--split", type=str, help="split to evaluate, <split>.tsv or <split>.parquet of dataset_dir", default="test")
+    parser.add_argument("--output_dir", type=str, help="dir of the onnx models and the report, defaults to <model_dir>/onnx", default=None)
+    parser.add_argument("--opset", type=int, help="onnx opset version", default=14)
+    parser.add_argument("--batch_size", type=int, help="max flows per batch of the accuracy pass", default=32)
+    parser.add_argument("--latency_batch_sizes", type=int, nargs="+", help="batch sizes of the latency pass", default=[1, 8, 32])
+    parser.add_argument("--latency_batches", type=int, help="timed batches per batch size and runtime", default=20)
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--num_proc", type=int, help="number of tokenization processes", default=os.cpu_count())
+    parser.add_argument("--token_cache_dir", type=str, help="tokenized dataset cache dir, defaults to <dataset_dir>/token_cache", default=None)
+    parser.add_argument("--num_threads", type=int, help="intra-op threads of both runtimes", default=os.cpu_count())
+    parser.add_argument("--skip_export", action="store_true", help="reuse the onnx models of output_dir")
+    args = parser.parse_args()
+    return args
+
+class LogitsModel(nn.Module):
+    """Positional inputs in, logits out, the signature torch.onnx.export traces"""
+
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).logits
+
+def export_onnx(model, input_names, path, opset=14):
+    """Export model to path with dynamic batch and sequence axes"""
+    dummy = {"input_ids": torch.ones(2, 16, dtype=torch.long), "attention_mask": torch.ones(2, 16, dtype=torch.long),
+             "token_type_ids": torch.zeros(2, 16, dtype=torch.long)}
+    if "num_features" in input_names:
+        dummy["num_features"] = torch.zeros(2, model.num_features)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names if name != "num_features"}
+    dynamic_axes["num_features"] = {0: "batch"}
+    dynamic_axes["logits"] = {0: "batch"}
+    # the wrapper must be in eval mode, export restores its mode on the wrapped model too
+    wrapper = LogitsModel(model, input_names).eval()
+    torch.onnx.export(wrapper, tuple(dummy[name] for name in input_names), path, input_names=input_names,
+                      output_names=["logits"], dynamic_axes={k: v for k, v in dynamic_axes.items() if k in input_names + ["logits"]},
+                      opset_version=opset, dynamo=False)
+
+def quantize_onnx(fp32_path, int8_path):
+    """Dynamic quantization: int8 weights of the MatMul/Gemm layers, activations quantized at run time"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+def torch_runner(model):
+    def run(inputs):
+        with torch.inference_mode():
+            return model(**{k: torch.from_numpy(v) for k, v in inputs.items()}).logits.float().numpy()
+    return run
+
+def onnx_runner(path, num_threads):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    names = [i.name for i in session.get_inputs()]
+    def run(inputs):
+        return session.run(["logits"], {name: inputs[name] for name in names})[0]
+    return run
+
+def batch_inputs(tokenizer, dataset, batch, input_names):
+    rows = dataset[batch]
+    inputs = tokenizer.pad({k: rows[k] for k in input_names if k != "num_features"}, return_tensors="np")
+    inputs = {k: v.astype(np.int64) for k, v in inputs.items()}
+    if "num_features" in input_names:
+        inputs["num_features"] = np.asarray(rows["num_features"], dtype=np.float32)
+    return inputs
+
+def iter_batches(tokenizer, dataset, batches, input_names):
+    """(row indices, padded inputs) of every batch, padded one at a time when the loop reaches it"""
+    for batch in batches:
+        yield batch, batch_inputs(tokenizer, dataset, batch, input_names)
+
+def evaluate_runner(run, batches, labels, num_labels):
+    """compute_metrics over the split, plus the logits to compare runtimes with"""
+    logits = np.zeros((len(labels), num_labels), dtype=np.float32)
+    for batch, inputs in batches:
+        logits[batch] = run(inputs)
+    return compute_metrics((logits, labels)), logits
+
+def time_runner(run, batches):
+    """latency_report of run over batches, padding the next batch is not timed"""
+    timings = []
+    for batch, inputs in batches:
+        start = time.perf_counter()
+        run(inputs)
+        timings.append((len(batch), time.perf_counter() - start))
+    return latency_report(timings, sum(seconds for _, seconds in timings))
+
+def size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.endswith((".bin", ".safetensors"))) / 2**20
+    return os.path.getsize(path) / 2**20
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.num_threads)
+    output_dir = args.output_dir or os.path.join(args.model_dir, ONNX_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_saved_model(args.model_dir).eval()
+    if isinstance(model, WindowPoolingModel):
+        raise ValueError("window pooling models encode a variable number of windows per flow and are not exportable, "
+                         "export a model trained with --pooling none")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_dir)
+
+    with_features = getattr(model, "num_features", 0) > 0
+    dataset = load_split(args.dataset_dir, args.split, with_features=with_features)
+    token_cache_dir = args.token_cache_dir or os.path.join(args.dataset_dir, "token_cache")
+    dataset = tokenize_dataset(dataset, tokenizer, token_cache_dir, load_instruction(args.dataset_dir), args.max_length, args.num_proc)
+    input_names = [c for c in ["input_ids", "attention_mask", "token_type_ids", "num_features"] if c in dataset.column_names]
+    labels = np.asarray(dataset["labels"], dtype=np.int64)
+    print(f"{args.split} size: {len(dataset)}")
+
+    fp32_path = os.path.join(output_dir, ONNX_FP32_FILE)
+    int8_path = os.path.join(output_dir, ONNX_INT8_FILE)
+    if not args.skip_export:
+        export_onnx(model, input_names, fp32_path, args.opset)
+        quantize_onnx(fp32_path, int8_path)
+        tokenizer.save_pretrained(output_dir)
+        model.config.save_pretrained(output_dir)
+        print(f"onnx models are saved in: {output_dir}")
+
+    runners = {
+        "torch_fp32": (torch_runner(model), size_mb(args.model_dir)),
+        "onnx_fp32": (onnx_runner(fp32_path, args.num_threads), size_mb(fp32_path)),
+        "onnx_int8": (onnx_runner(int8_path, args.num_threads), size_mb(int8_path)),
+    }
+    # every runtime sees the same batches: length-sorted ones for accuracy, random ones for latency;
+    # only their row indices are kept, each batch is padded when the loop reaches it
+    batches = TokenBudgetBatchSampler(dataset["length"], float("inf"), max_batch_size=args.batch_size).batches
+    rng = np.random.RandomState(42)
+    latency_batches = {
+        batch_size: [rng.choice(len(dataset), min(batch_size, len(dataset)), replace=False).tolist() for _ in range(args.latency_batches)]
+        for batch_size in args.latency_batch_sizes
+    }
+
+    report = {"params": {k: getattr(args, k) for k in ["model_dir", "split", "opset", "batch_size", "latency_batch_sizes",
+                                                       "latency_batches", "max_length", "num_threads"]},
+              "samples": len(dataset), "runtimes": {}}
+    reference = None
+    for name, (run, size) in runners.items():
+        metrics, logits = evaluate_runner(run, iter_batches(tokenizer, dataset, batches, input_names), labels, model_num_labels(model))
+        # one untimed batch, so session and allocator warm-up stays out of the percentiles
+        run(batch_inputs(tokenizer, dataset, next(iter(latency_batches.values()))[0], input_names))
+        result = {"size_mb": size, "metrics": metrics,
+                  "latency": {str(bs): time_runner(run, iter_batches(tokenizer, dataset, b, input_names))
+                              for bs, b in latency_batches.items()}}
+        if reference is None:
+            reference = logits
+        else:
+            result["agreement"] = float((logits.argmax(axis=1) == reference.argmax(axis=1)).mean())
+            result["max_logit_diff"] = float(np.abs(logits - reference).max())
+        report["runtimes"][name] = result
+        print(f"{name}: size {size:.1f}MB, accuracy {metrics['accuracy']:.4f}, f1 {metrics['f1']:.4f}, "
+              + ", ".join(f"bs {bs} p50/p99 {r['batch_ms']['p50']:.1f}/{r['batch_ms']['p99']:.1f}ms"
+                          for bs, r in result["latency"].items()))
+
+    report_path = os.path.join(output_dir, ONNX_REPORT_FILE)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"report is saved in: {report_path}")
+
+if __name__ == "__main__":
+    main()
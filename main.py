@@ -1,23 +1,50 @@
 import os
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
+import re
+import sys
+import time
+import json
+import copy
+import shutil
 import argparse
 import numpy as np
+import torch
+from torch import nn
 import pandas as pd
-from datasets import Dataset
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+from datasets import Dataset, load_from_disk
+from datasets.fingerprint import Hasher
 from transformers import (
+    AutoConfig,
+    AutoModel,
     AutoTokenizer, 
     AutoModelForSequenceClassification, 
     TrainingArguments, 
     Trainer,
     DataCollatorWithPadding,
-    EarlyStoppingCallback
+    EarlyStoppingCallback,
+    TrainerCallback
 )
+from torch.utils.data import DataLoader, Sampler
+from transformers.modeling_outputs import SequenceClassifierOutput
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocess"))
+from stage_metrics import METRICS, profiled
+from preprocess_utils import FEATURE_MATRIX_SUFFIX, FEATURE_STATS_FILE, RENDER_CONFIG_FILE, WINDOW_SEP, load_render_config
+
+FUSION_CONFIG_FILE = "fusion_config.json"
+WINDOW_CONFIG_FILE = "window_config.json"
+DISTILL_REPORT_FILE = "distill_report.json"
+PREDICTIONS_SUFFIX = "_predictions.parquet"
+EVAL_REPORT_SUFFIX = "_metrics.json"
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--task_name", type=str, help="task name", required=True)
-    parser.add_argument("--model_name", type=str, help="pretrained model name", required=True)
+    parser.add_argument("--model_name", type=str, help="pretrained model name, not needed with --teacher_dir", default=None)
     parser.add_argument("--num_labels", type=int, help="number of label", required=True)
     parser.add_argument("--batch_size", type=int, help="batch size", required=True)
     parser.add_argument("--epoch", type=int, help="epoch", required=True)
@@ -25,25 +52,422 @@ def get_args():
     parser.add_argument("--output_dir", type=str, help="output directory", required=True)
     parser.add_argument("--dataset_dir", type=str, help="data dir", required=True)
     parser.add_argument("--log_dir", type=str, help="log dir", required=True)
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--num_proc", type=int, help="number of tokenization processes", default=os.cpu_count())
+    parser.add_argument("--pad_to_max_length", action="store_true", help="pad every sample to max_length instead of dynamic padding of length-grouped batches")
+    parser.add_argument("--max_tokens", type=int, help="cap training batches by padded token count instead of batch size", default=None)
+    parser.add_argument("--token_cache_dir", type=str, help="tokenized dataset cache dir, defaults to <dataset_dir>/token_cache", default=None)
+    parser.add_argument("--ignore_features", action="store_true", help="train on the text only even when the dataset has numeric feature matrices")
+    parser.add_argument("--feature_hidden", type=int, help="size of the numeric feature projection of the fusion head", default=128)
+    parser.add_argument("--metrics_report", type=str, help="json stage timing report, defaults to <output_dir>/metrics.json", default=None)
+    parser.add_argument("--profile", type=str, help="write cProfile stats to <profile>.<pid>.prof", default=None)
+    parser.add_argument("--teacher_dir", type=str, help="trained final_model to distill into a smaller student instead of fine-tuning --model_name", default=None)
+    parser.add_argument("--student_layers", type=int, help="student encoder layers, defaults to half of the teacher's", default=None)
+    parser.add_argument("--student_hidden", type=int, help="student hidden size, defaults to the teacher's", default=None)
+    parser.add_argument("--student_heads", type=int, help="student attention heads, defaults to hidden size / 64", default=None)
+    parser.add_argument("--distill_temperature", type=float, help="softmax temperature of the soft labels", default=2.0)
+    parser.add_argument("--distill_alpha", type=float, help="weight of the soft-label loss, the hard-label loss gets 1 - alpha", default=0.5)
+    parser.add_argument("--pooling", type=str, choices=["none", "mean", "attention"], default="none",
+                        help="encode the packet windows of flows preprocessed with --window_packets separately and pool them")
+    parser.add_argument("--max_windows", type=int, help="packet windows kept per flow with --pooling, each truncated to max_length, saved with the model", default=40)
+    parser.add_argument("--window_batch", type=int, help="windows per encoder call with --pooling", default=32)
+    parser.add_argument("--speed_flows", type=int, help="test flows timed on CPU for the teacher/student speedup", default=512)
 
     args = parser.parse_args()
+    if not args.model_name and not args.teacher_dir:
+        parser.error("--model_name is required unless --teacher_dir is given")
     return args
 
-def load_data(dir):
-    train_df = pd.read_csv(os.path.join(dir, "train.tsv"))
-    val_df = pd.read_csv(os.path.join(dir, "val.tsv"))
-    test_df = pd.read_csv(os.path.join(dir, "test.tsv"))
-    
-    train_dataset = Dataset.from_pandas(train_df).shuffle(seed=42)
-    val_dataset = Dataset.from_pandas(val_df).shuffle(seed=42)
-    test_dataset = Dataset.from_pandas(test_df).shuffle(seed=42)
+def load_instruction(dir):
+    """Instruction prefix stored in the metadata of a Parquet dataset, CSV datasets keep it in every row"""
+    path = os.path.join(dir, "train.parquet")
+    if not os.path.exists(path):
+        return ""
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(b"instruction", b"").decode("utf-8")
+
+def add_feature_column(dataset, dir, split, with_features=True):
+    """Attach the row-aligned <split>.features.npy matrix written by preprocess.py as num_features"""
+    path = os.path.join(dir, split + FEATURE_MATRIX_SUFFIX)
+    if not with_features or not os.path.exists(path):
+        return dataset
+    return dataset.add_column("num_features", np.load(path).tolist())
+
+def load_split(dir, split, with_features=True):
+    """One split of a preprocessed dataset, as written by preprocess.py, with its feature matrix when asked"""
+    if os.path.exists(os.path.join(dir, split + ".parquet")):
+        # Arrow files are memory-mapped by datasets instead of being parsed through pandas
+        dataset = Dataset.from_parquet(os.path.join(dir, split + ".parquet"))
+    else:
+        dataset = Dataset.from_pandas(pd.read_csv(os.path.join(dir, split + ".tsv")))
+    return add_feature_column(dataset, dir, split, with_features)
+
+def load_data(dir, with_features=True):
+    train_dataset, val_dataset = [load_split(dir, split, with_features).shuffle(seed=42) for split in ["train", "val"]]
+    # kept in file order, so that the rows of the test predictions are those of the test split
+    test_dataset = load_split(dir, "test", with_features)
     
     print(f"train size: {len(train_dataset)},val size: {len(val_dataset)}, test size: {len(test_dataset)}")
     
     return train_dataset, val_dataset, test_dataset
 
-def preprocess_function(examples, tokenizer):
-    return tokenizer(examples["inputs"], truncation=True, padding="max_length", max_length=512)
+def preprocess_function(examples, tokenizer, instruction="", max_length=512, pad_to_max_length=False, max_windows=0):
+    inputs = [instruction + x for x in examples["inputs"]] if instruction else examples["inputs"]
+    if max_windows:
+        return tokenize_windows(inputs, tokenizer, max_length, max_windows)
+    # without padding here, DataCollatorWithPadding pads each batch to its longest sample
+    result = tokenizer(inputs, truncation=True, padding="max_length" if pad_to_max_length else False, max_length=max_length)
+    result["length"] = [len(ids) for ids in result["input_ids"]]
+    return result
+
+def tokenize_windows(inputs, tokenizer, max_length=512, max_windows=40):
+    """Tokenize the first max_windows packet windows of every flow separately, each truncated to max_length.
+
+    Every tokenizer output becomes a list of windows per flow, length is the
+    flow's token total.
+    """
+    windows = [x.split(WINDOW_SEP)[:max_windows] for x in inputs]
+    encoded = tokenizer([w for flow in windows for w in flow], truncation=True, max_length=max_length)
+    result = {k: [] for k in encoded.keys()}
+    offset = 0
+    for flow in windows:
+        for k in encoded.keys():
+            result[k].append(encoded[k][offset:offset + len(flow)])
+        offset += len(flow)
+    result["length"] = [sum(len(ids) for ids in flow) for flow in result["input_ids"]]
+    return result
+
+def tokenize_dataset(dataset, tokenizer, cache_dir, instruction="", max_length=512, num_proc=None, pad_to_max_length=False, max_windows=0):
+    """Tokenize dataset, reusing a previous run's result saved under cache_dir.
+
+    The cache key covers the dataset fingerprint, the tokenizer and max_length; cached
+    splits are Arrow files that load_from_disk memory-maps. max_windows > 0
+    tokenizes the packet windows of each flow separately, see tokenize_windows.
+    """
+    key_parts = [dataset._fingerprint, tokenizer.name_or_path, Hasher.hash(tokenizer), instruction, max_length, pad_to_max_length]
+    key = Hasher.hash(key_parts + [max_windows] if max_windows else key_parts)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(path):
+        print(f"load tokenized dataset from: {path}")
+        return load_from_disk(path)
+
+    dataset = dataset.map(preprocess_function, batched=True, num_proc=num_proc,
+                          fn_kwargs={"tokenizer": tokenizer, "instruction": instruction, "max_length": max_length, "pad_to_max_length": pad_to_max_length,
+                                     "max_windows": max_windows})
+    dataset = dataset.remove_columns(["inputs", "str_labels"])
+    dataset.save_to_disk(path)
+    return dataset
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batches of similar-length samples whose padded size (longest sample x batch size) fits in max_tokens.
+
+    As in fairseq, batches are packed once from the length-sorted samples and only
+    their order is reshuffled every epoch, so the number of steps stays fixed.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, seed=42):
+        self.seed = seed
+        self.epoch = 0
+        self.batches = []
+        batch = []
+        longest = 0
+        for idx in np.argsort(lengths, kind="stable"):
+            length = lengths[idx]
+            if batch and (max(longest, length) * (len(batch) + 1) > max_tokens or len(batch) == max_batch_size):
+                self.batches.append(batch)
+                batch, longest = [], 0
+            batch.append(int(idx))
+            longest = max(longest, length)
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.batches))
+        self.epoch += 1
+        for i in order:
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+
+def encode_first_token(encoder, input_ids, attention_mask=None, token_type_ids=None):
+    """First-token hidden state of every sequence"""
+    kwargs = {}
+    if token_type_ids is not None:
+        kwargs["token_type_ids"] = token_type_ids
+    if encoder.config.model_type == "longformer":
+        # global attention on the first token, as LongformerForSequenceClassification does
+        kwargs["global_attention_mask"] = torch.zeros_like(input_ids)
+        kwargs["global_attention_mask"][:, 0] = 1
+    return encoder(input_ids=input_ids, attention_mask=attention_mask, **kwargs).last_hidden_state[:, 0]
+
+class FeatureFusionModel(nn.Module):
+    """Sequence classifier over the encoder's first-token output concatenated with a projection of the numeric CIC features.
+
+    Checkpoints hold the full state dict; save_config() adds what
+    from_pretrained() needs to rebuild the model without the base checkpoint.
+    """
+
+    def __init__(self, encoder, num_features, num_labels, feature_hidden=128, dropout=0.1):
+        super().__init__()
+        self.encoder = encoder
+        self.config = encoder.config
+        self.num_features = num_features
+        self.num_labels = num_labels
+        self.feature_hidden = feature_hidden
+        self.feature_proj = nn.Sequential(nn.Linear(num_features, feature_hidden), nn.GELU(), nn.LayerNorm(feature_hidden))
+        self.dropout = nn.Dropout(dropout)
+        self.classifier = nn.Linear(encoder.config.hidden_size + feature_hidden, num_labels)
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, num_features=None, labels=None):
+        hidden = encode_first_token(self.encoder, input_ids, attention_mask, token_type_ids)
+        if num_features is None:
+            num_features = hidden.new_zeros(hidden.shape[0], self.num_features)
+        fused = torch.cat([hidden, self.feature_proj(num_features.to(hidden.dtype))], dim=-1)
+        logits = self.classifier(self.dropout(fused))
+        loss = nn.functional.cross_entropy(logits, labels) if labels is not None else None
+        return SequenceClassifierOutput(loss=loss, logits=logits)
+
+    def save_config(self, save_directory, dataset_dir=None):
+        self.config.save_pretrained(save_directory)
+        with open(os.path.join(save_directory, FUSION_CONFIG_FILE), "w") as f:
+            json.dump({"num_features": self.num_features, "num_labels": self.num_labels, "feature_hidden": self.feature_hidden}, f)
+        # the normalization statistics travel with the model so new traffic is scaled the same way
+        if dataset_dir and os.path.exists(os.path.join(dataset_dir, FEATURE_STATS_FILE)):
+            shutil.copy(os.path.join(dataset_dir, FEATURE_STATS_FILE), save_directory)
+
+    @classmethod
+    def from_pretrained(cls, model_dir):
+        with open(os.path.join(model_dir, FUSION_CONFIG_FILE)) as f:
+            fusion_config = json.load(f)
+        model = cls(AutoModel.from_config(AutoConfig.from_pretrained(model_dir)), **fusion_config)
+        model.load_state_dict(torch.load(os.path.join(model_dir, "pytorch_model.bin"), map_location="cpu"))
+        return model
+
+class WindowPoolingModel(nn.Module):
+    """Flow classifier over packet windows encoded independently and pooled into one flow representation.
+
+    The windows of a batch come flattened with flow_index, the flow of each
+    window (see WindowCollator); they are encoded window_batch at a time, so
+    attention cost stays quadratic in the window length only and memory grows
+    linearly with the number of windows. pooling is "mean" or "attention", a
+    learned softmax over the windows of a flow. Numeric features, when given,
+    are fused after pooling as in FeatureFusionModel.
+
+    max_windows, and the max_packets and window_packets the training flows were
+    rendered with (None when unknown), are saved with the model so that new
+    traffic is rendered and tokenized as in training.
+    """
+
+    def __init__(self, encoder, num_labels, pooling="mean", window_batch=32, num_features=0, feature_hidden=128, dropout=0.1,
+                 max_windows=40, max_packets=None, window_packets=None):
+        super().__init__()
+        self.encoder = encoder
+        self.config = encoder.config
+        self.num_labels = num_labels
+        self.pooling = pooling
+        self.window_batch = window_batch
+        self.num_features = num_features
+        self.feature_hidden = feature_hidden
+        self.max_windows = max_windows
+        self.max_packets = max_packets
+        self.window_packets = window_packets
+        hidden_size = encoder.config.hidden_size
+        if pooling == "attention":
+            self.attention = nn.Linear(hidden_size, 1)
+        if num_features:
+            self.feature_proj = nn.Sequential(nn.Linear(num_features, feature_hidden), nn.GELU(), nn.LayerNorm(feature_hidden))
+            hidden_size += feature_hidden
+        self.dropout = nn.Dropout(dropout)
+        self.classifier = nn.Linear(hidden_size, num_labels)
+
+    def pool(self, hidden, flow_index, num_flows):
+        if self.pooling == "attention":
+            scores = self.attention(hidden).squeeze(-1)
+            flow_max = scores.new_full((num_flows,), float("-inf")).scatter_reduce(0, flow_index, scores, reduce="amax")
+            weights = torch.exp(scores - flow_max[flow_index])
+            weights = weights / weights.new_zeros(num_flows).index_add(0, flow_index, weights)[flow_index]
+            return hidden.new_zeros(num_flows, hidden.shape[-1]).index_add(0, flow_index, hidden * weights.unsqueeze(-1))
+        counts = torch.bincount(flow_index, minlength=num_flows).clamp(min=1).to(hidden.dtype)
+        return hidden.new_zeros(num_flows, hidden.shape[-1]).index_add(0, flow_index, hidden) / counts.unsqueeze(-1)
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, flow_index=None, num_features=None, labels=None):
+        hidden = torch.cat([
+            encode_first_token(self.encoder, input_ids[i:i + self.window_batch],
+                               attention_mask[i:i + self.window_batch] if attention_mask is not None else None,
+                               token_type_ids[i:i + self.window_batch] if token_type_ids is not None else None)
+            for i in range(0, input_ids.shape[0], self.window_batch)])
+        if flow_index is None:
+            flow_index = torch.zeros(hidden.shape[0], dtype=torch.long, device=hidden.device)
+        pooled = self.pool(hidden, flow_index, int(flow_index.max()) + 1)
+        if self.num_features:
+            if num_features is None:
+                num_features = pooled.new_zeros(pooled.shape[0], self.num_features)
+            pooled = torch.cat([pooled, self.feature_proj(num_features.to(pooled.dtype))], dim=-1)
+        logits = self.classifier(self.dropout(pooled))
+        # one term per flow whatever its number of windows, the windows are pooled before the loss
+        loss = nn.functional.cross_entropy(logits, labels) if labels is not None else None
+        return SequenceClassifierOutput(loss=loss, logits=logits)
+
+    def save_config(self, save_directory, dataset_dir=None):
+        self.config.save_pretrained(save_directory)
+        with open(os.path.join(save_directory, WINDOW_CONFIG_FILE), "w") as f:
+            json.dump({"num_labels": self.num_labels, "pooling": self.pooling, "window_batch": self.window_batch,
+                       "num_features": self.num_features, "feature_hidden": self.feature_hidden, "max_windows": self.max_windows,
+                       "max_packets": self.max_packets, "window_packets": self.window_packets}, f)
+        if dataset_dir and self.num_features and os.path.exists(os.path.join(dataset_dir, FEATURE_STATS_FILE)):
+            shutil.copy(os.path.join(dataset_dir, FEATURE_STATS_FILE), save_directory)
+
+    @classmethod
+    def from_pretrained(cls, model_dir):
+        with open(os.path.join(model_dir, WINDOW_CONFIG_FILE)) as f:
+            window_config = json.load(f)
+        model = cls(AutoModel.from_config(AutoConfig.from_pretrained(model_dir)), **window_config)
+        model.load_state_dict(torch.load(os.path.join(model_dir, "pytorch_model.bin"), map_location="cpu"))
+        return model
+
+class WindowCollator:
+    """Flatten the windows of a batch of flows into one padded batch of windows, with the flow index of each window"""
+
+    def __init__(self, tokenizer):
+        self.pad = DataCollatorWithPadding(tokenizer=tokenizer)
+
+    def __call__(self, features):
+        windows = []
+        flow_index = []
+        for i, feature in enumerate(features):
+            for j in range(len(feature["input_ids"])):
+                windows.append({k: feature[k][j] for k in ["input_ids", "attention_mask", "token_type_ids"] if k in feature})
+                flow_index.append(i)
+        # the per flow tensors come first: Trainer takes the batch size from the first tensor (find_batch_size)
+        # to weight the loss of a batch, which must count flows and not windows
+        batch = {}
+        if "labels" in features[0]:
+            batch["labels"] = torch.tensor([feature["labels"] for feature in features], dtype=torch.long)
+        if "num_features" in features[0]:
+            batch["num_features"] = torch.tensor([feature["num_features"] for feature in features], dtype=torch.float32)
+        batch.update(self.pad(windows))
+        batch["flow_index"] = torch.tensor(flow_index, dtype=torch.long)
+        return batch
+
+def load_model(model_name, num_labels, num_features=0, feature_hidden=128, pooling="none", window_batch=32):
+    if pooling != "none":
+        return WindowPoolingModel(AutoModel.from_pretrained(model_name), num_labels, pooling, window_batch, num_features, feature_hidden)
+    if not num_features:
+        return AutoModelForSequenceClassification.from_pretrained(pretrained_model_name_or_path=model_name, num_labels=num_labels)
+    return FeatureFusionModel(AutoModel.from_pretrained(model_name), num_features, num_labels, feature_hidden)
+
+def load_saved_model(model_dir):
+    """A final_model saved by train(): a WindowPoolingModel or a FeatureFusionModel when it has their config"""
+    if os.path.exists(os.path.join(model_dir, WINDOW_CONFIG_FILE)):
+        return WindowPoolingModel.from_pretrained(model_dir)
+    if os.path.exists(os.path.join(model_dir, FUSION_CONFIG_FILE)):
+        return FeatureFusionModel.from_pretrained(model_dir)
+    return AutoModelForSequenceClassification.from_pretrained(model_dir)
+
+LAYER_PATTERN = re.compile(r"\.layer\.(\d+)\.")
+
+def build_student(teacher, num_layers=None, hidden_size=None, num_heads=None):
+    """A smaller model of the teacher's architecture, with the teacher weights whose shape still fits.
+
+    Student layer i starts from teacher layer (i + 1) * teacher layers / student layers - 1,
+    so the last layers are kept; with a smaller hidden size the student starts from scratch.
+    """
+    config = copy.deepcopy(teacher.config)
+    teacher_layers = config.num_hidden_layers
+    config.num_hidden_layers = num_layers or max(teacher_layers // 2, 1)
+    if hidden_size and hidden_size != config.hidden_size:
+        config.hidden_size = hidden_size
+        config.intermediate_size = 4 * hidden_size
+        config.num_attention_heads = num_heads or max(hidden_size // 64, 1)
+    elif num_heads:
+        config.num_attention_heads = num_heads
+    if isinstance(getattr(config, "attention_window", None), list):
+        config.attention_window = config.attention_window[:config.num_hidden_layers]
+    if isinstance(teacher, WindowPoolingModel):
+        student = WindowPoolingModel(AutoModel.from_config(config), teacher.num_labels, teacher.pooling, teacher.window_batch,
+                                     teacher.num_features, teacher.feature_hidden, max_windows=teacher.max_windows,
+                                     max_packets=teacher.max_packets, window_packets=teacher.window_packets)
+    elif isinstance(teacher, FeatureFusionModel):
+        student = FeatureFusionModel(AutoModel.from_config(config), teacher.num_features, teacher.num_labels, teacher.feature_hidden)
+    else:
+        student = AutoModelForSequenceClassification.from_config(config)
+
+    teacher_state = teacher.state_dict()
+    state = student.state_dict()
+    copied = 0
+    for name, value in state.items():
+        source = LAYER_PATTERN.sub(lambda m: f".layer.{(int(m.group(1)) + 1) * teacher_layers // config.num_hidden_layers - 1}.", name)
+        if source in teacher_state and teacher_state[source].shape == value.shape:
+            state[name] = teacher_state[source]
+            copied += 1
+    student.load_state_dict(state)
+    print(f"student: {config.num_hidden_layers} layers, hidden size {config.hidden_size}, {copied}/{len(state)} tensors from the teacher")
+    return student
+
+class FlowTrainer(Trainer):
+    """Trainer whose training batches can be capped by a token budget instead of a sample count"""
+
+    def __init__(self, *args, max_tokens=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens = max_tokens
+
+    def get_train_dataloader(self):
+        if not self.max_tokens:
+            return super().get_train_dataloader()
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        batch_sampler = TokenBudgetBatchSampler(self.train_dataset["length"], self.max_tokens, seed=self.args.seed)
+        return DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+class DistillationTrainer(FlowTrainer):
+    """FlowTrainer of a student against a frozen teacher.
+
+    The loss is alpha * T^2 * KL(teacher || student) over the temperature T softmaxes
+    plus (1 - alpha) * the cross entropy with the labels.
+    """
+
+    def __init__(self, *args, teacher=None, temperature=2.0, alpha=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        outputs = model(**inputs)
+        with torch.no_grad():
+            teacher_logits = self.teacher(**inputs).logits
+        t = self.temperature
+        soft_loss = nn.functional.kl_div(nn.functional.log_softmax(outputs.logits / t, dim=-1),
+                                         nn.functional.softmax(teacher_logits / t, dim=-1), reduction="batchmean") * t * t
+        loss = self.alpha * soft_loss + (1 - self.alpha) * outputs.loss
+        return (loss, outputs) if return_outputs else loss
+
+class ModelConfigCallback(TrainerCallback):
+    """Save the config of a fusion or window pooling model into every checkpoint, so that load_saved_model can evaluate them"""
+
+    def __init__(self, dataset_dir):
+        self.dataset_dir = dataset_dir
+
+    def on_save(self, args, state, control, model=None, **kwargs):
+        model.save_config(os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}"), self.dataset_dir)
+
+class StageMetricsCallback(TrainerCallback):
+    """Time every optimizer step and count evaluations into METRICS"""
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        METRICS.add_time("train_step", time.perf_counter() - self.step_start)
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        METRICS.count("evaluations")
 
 def compute_metrics(eval_pred):
     predictions, labels = eval_pred
@@ -62,21 +486,130 @@ def compute_metrics(eval_pred):
         "cm": cm.tolist()
     }
 
+class StreamingMetrics:
+    """The compute_metrics metrics from a confusion matrix updated batch by batch, without holding the logits.
+
+    Macro averages run over the labels that occur in the labels or the
+    predictions and count undefined ratios as 0, as sklearn does.
+    """
+
+    def __init__(self, num_labels):
+        self.num_labels = num_labels
+        self.cm = np.zeros((num_labels, num_labels), dtype=np.int64)
+        self.loss_sum = 0.0
+
+    def update(self, predictions, labels, loss_sum=0.0):
+        k = self.num_labels
+        self.cm += np.bincount(np.asarray(labels) * k + np.asarray(predictions), minlength=k * k).reshape(k, k)
+        self.loss_sum += loss_sum
+
+    def result(self):
+        tp = np.diag(self.cm).astype(np.float64)
+        predicted = self.cm.sum(axis=0)
+        actual = self.cm.sum(axis=1)
+        present = (predicted + actual) > 0
+        precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+        recall = np.divide(tp, actual, out=np.zeros_like(tp), where=actual > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros_like(tp), where=(precision + recall) > 0)
+        samples = int(self.cm.sum())
+        return {
+            "samples": samples,
+            "loss": self.loss_sum / samples if samples else 0.0,
+            "accuracy": float(tp.sum() / samples) if samples else 0.0,
+            "precision": float(precision[present].mean()) if present.any() else 0.0,
+            "recall": float(recall[present].mean()) if present.any() else 0.0,
+            "f1": float(f1[present].mean()) if present.any() else 0.0,
+            "cm": self.cm.tolist(),
+        }
+
+def streaming_evaluate(model, dataset, data_collator, num_labels, batch_size, max_tokens=None, output_path=None, device="cpu"):
+    """Evaluate model on a tokenized split one length-sorted batch at a time.
+
+    Metrics are accumulated in StreamingMetrics and, with output_path, every
+    batch of per-sample predictions (row index in dataset, label, prediction
+    and class probabilities) is appended to a Parquet file, so memory does not grow
+    with the split. Splits without labels only get their predictions written.
+    """
+    model.to(device).eval()
+    metrics = StreamingMetrics(num_labels)
+    input_columns = [c for c in ["input_ids", "attention_mask", "token_type_ids", "num_features"] if c in dataset.column_names]
+    with_labels = "labels" in dataset.column_names
+    batches = TokenBudgetBatchSampler(dataset["length"], max_tokens or float("inf"), max_batch_size=batch_size).batches
+    writer = None
+    try:
+        with torch.inference_mode():
+            for batch in tqdm(batches, desc="evaluate"):
+                rows = dataset[batch]
+                inputs = data_collator([{c: rows[c][i] for c in input_columns} for i in range(len(batch))])
+                logits = model(**{k: v.to(device) for k, v in inputs.items()}).logits.float()
+                probs = torch.softmax(logits, dim=-1).cpu().numpy()
+                predictions = probs.argmax(axis=1)
+                columns = {"index": np.asarray(batch, dtype=np.int64)}
+                if with_labels:
+                    labels = np.asarray(rows["labels"], dtype=np.int64)
+                    loss_sum = nn.functional.cross_entropy(logits, torch.from_numpy(labels).to(device), reduction="sum").item()
+                    metrics.update(predictions, labels, loss_sum)
+                    columns["label"] = labels
+                columns["prediction"] = predictions
+                for i in range(num_labels):
+                    columns[f"prob_{i}"] = probs[:, i]
+                if output_path:
+                    table = pa.table(columns)
+                    if writer is None:
+                        writer = pq.ParquetWriter(output_path, table.schema)
+                    writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return metrics.result() if with_labels else {"samples": len(dataset)}
+
+def model_num_labels(model):
+    return getattr(model, "num_labels", None) or model.config.num_labels
+
 def main():
     args = get_args()
+    start = time.perf_counter()
+    with profiled(args.profile):
+        train(args)
+    report_path = args.metrics_report or os.path.join(args.output_dir, "metrics.json")
+    METRICS.write_report(report_path, time.perf_counter() - start, task_name=args.task_name, model_name=args.model_name or args.teacher_dir)
+    print(f"metrics report is saved in: {report_path}")
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-    model = AutoModelForSequenceClassification.from_pretrained(
-        pretrained_model_name_or_path=args.model_name, num_labels=args.num_labels
-    )
-    
-    train_dataset, val_dataset, test_dataset = load_data(args.dataset_dir)
+def train(args):
+    teacher = load_saved_model(args.teacher_dir) if args.teacher_dir else None
+    # a student sees the features and the windows exactly when its teacher was trained on them
+    with_features = getattr(teacher, "num_features", 0) > 0 if teacher is not None else not args.ignore_features
+    pooling = getattr(teacher, "pooling", "none") if teacher is not None else args.pooling
+    max_windows = (teacher.max_windows if teacher is not None else args.max_windows) if pooling != "none" else 0
+    with METRICS.stage("load_data"):
+        train_dataset, val_dataset, test_dataset = load_data(args.dataset_dir, with_features=with_features)
+    num_features = len(train_dataset[0]["num_features"]) if "num_features" in train_dataset.column_names else 0
+    if num_features:
+        print(f"fusing {num_features} numeric features with the pooled output")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.teacher_dir or args.model_name)
+    if teacher is not None:
+        model = build_student(teacher, args.student_layers, args.student_hidden, args.student_heads)
+    else:
+        model = load_model(args.model_name, args.num_labels, num_features, args.feature_hidden, pooling, args.window_batch)
+    if max_windows:
+        print(f"encoding up to {max_windows} packet windows per flow with {pooling} pooling")
+        render_config = load_render_config(args.dataset_dir)
+        model.max_windows = max_windows
+        model.max_packets = render_config.get("max_packets", model.max_packets)
+        model.window_packets = render_config.get("window_packets", model.window_packets)
 
-    train_dataset = train_dataset.map(preprocess_function, batched=True, fn_kwargs={"tokenizer": tokenizer}).remove_columns(["inputs", "str_labels"])
-    val_dataset = val_dataset.map(preprocess_function, batched=True, fn_kwargs={"tokenizer": tokenizer}).remove_columns(["inputs", "str_labels"])
-    test_dataset = test_dataset.map(preprocess_function, batched=True, fn_kwargs={"tokenizer": tokenizer}).remove_columns(["inputs", "str_labels"])
+    instruction = load_instruction(args.dataset_dir)
+
+    token_cache_dir = args.token_cache_dir or os.path.join(args.dataset_dir, "token_cache")
+    with METRICS.stage("tokenize"):
+        train_dataset = tokenize_dataset(train_dataset, tokenizer, token_cache_dir, instruction, args.max_length, args.num_proc, args.pad_to_max_length, max_windows)
+        val_dataset = tokenize_dataset(val_dataset, tokenizer, token_cache_dir, instruction, args.max_length, args.num_proc, args.pad_to_max_length, max_windows)
+        test_dataset = tokenize_dataset(test_dataset, tokenizer, token_cache_dir, instruction, args.max_length, args.num_proc, args.pad_to_max_length, max_windows)
+    METRICS.count("train_samples", len(train_dataset))
+    METRICS.count("train_tokens", int(np.sum(train_dataset["length"])))
     
-    data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    data_collator = WindowCollator(tokenizer) if max_windows else DataCollatorWithPadding(tokenizer=tokenizer)
     
     training_args = TrainingArguments(
         run_name=args.task_name,
@@ -87,6 +620,8 @@ def main():
         learning_rate=args.learning_rate,
         per_device_train_batch_size=args.batch_size,
         per_device_eval_batch_size=args.batch_size,
+        group_by_length=not args.pad_to_max_length,
+        length_column_name="length",
         num_train_epochs= args.epoch,
         weight_decay=0.01,
         evaluation_strategy="epoch",
@@ -99,7 +634,10 @@ def main():
         push_to_hub=False,
     )
     
-    trainer = Trainer(
+    distill_kwargs = {}
+    if teacher is not None:
+        distill_kwargs = {"teacher": teacher, "temperature": args.distill_temperature, "alpha": args.distill_alpha}
+    trainer = (DistillationTrainer if teacher is not None else FlowTrainer)(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
@@ -107,18 +645,72 @@ def main():
         tokenizer=tokenizer,
         data_collator=data_collator,
         compute_metrics=compute_metrics,
-        callbacks=[EarlyStoppingCallback(early_stopping_patience=3)]
+        callbacks=[EarlyStoppingCallback(early_stopping_patience=3), StageMetricsCallback()]
+                  + ([ModelConfigCallback(args.dataset_dir)] if hasattr(model, "save_config") else []),
+        max_tokens=args.max_tokens,
+        **distill_kwargs,
     )
     
-    trainer.train()
+    with METRICS.stage("train"):
+        trainer.train()
+    METRICS.count("train_steps", trainer.state.global_step)
     
-    result = trainer.evaluate()
+    with METRICS.stage("evaluate"):
+        result = streaming_evaluate(trainer.model, val_dataset, data_collator, args.num_labels, args.batch_size, args.max_tokens,
+                                    device=training_args.device)
     print(f"val result: {result}")
-    result = trainer.predict(test_dataset)
+    with METRICS.stage("predict"):
+        result = streaming_evaluate(trainer.model, test_dataset, data_collator, args.num_labels, args.batch_size, args.max_tokens,
+                                    os.path.join(args.output_dir, "test" + PREDICTIONS_SUFFIX), training_args.device)
     print(f"test result: {result}")
+    with open(os.path.join(args.output_dir, "test" + EVAL_REPORT_SUFFIX), "w") as f:
+        json.dump(result, f, indent=2)
+    if teacher is not None:
+        with METRICS.stage("predict_teacher"):
+            teacher_result = streaming_evaluate(teacher, test_dataset, data_collator, args.num_labels, args.batch_size, args.max_tokens,
+                                                device=training_args.device)
     
-    trainer.save_model(os.path.join(args.output_dir, "final_model"))
+    with METRICS.stage("save_model"):
+        trainer.save_model(os.path.join(args.output_dir, "final_model"))
+        if hasattr(model, "save_config"):
+            model.save_config(os.path.join(args.output_dir, "final_model"), args.dataset_dir)
+        # the rendering of the training flows travels with every model, so predict.py renders pcap input the same way
+        if os.path.exists(os.path.join(args.dataset_dir, RENDER_CONFIG_FILE)):
+            shutil.copy(os.path.join(args.dataset_dir, RENDER_CONFIG_FILE), os.path.join(args.output_dir, "final_model"))
     print(f"model is saved in: {os.path.join(args.output_dir, 'final_model')}")
 
+    if teacher is not None:
+        with METRICS.stage("distillation_report"):
+            report = distillation_report(args, teacher_result, result, teacher, model)
+        print(f"distillation report is saved in: {os.path.join(args.output_dir, DISTILL_REPORT_FILE)}")
+        print(f"student vs teacher: accuracy {report['accuracy_delta']:+.4f}, f1 {report['f1_delta']:+.4f}, "
+              f"{report['cpu_speedup']:.2f}x CPU flows/s")
+
+def distillation_report(args, teacher_metrics, student_metrics, teacher, student):
+    """Test accuracy/F1 of the teacher and the student, and their CPU throughput through predict.py on the same test flows"""
+    from predict import FlowClassifier, load_dataset_inputs, latency_report
+
+    texts, _, _, features = load_dataset_inputs(args.dataset_dir, "test")
+    texts = texts[:args.speed_flows]
+    features = features[:args.speed_flows] if features is not None else None
+    report = {}
+    for name, model_dir, metrics, model in [("teacher", args.teacher_dir, teacher_metrics, teacher),
+                                            ("student", os.path.join(args.output_dir, "final_model"), student_metrics, student)]:
+        classifier = FlowClassifier(model_dir, args.max_length, args.batch_size)
+        # one untimed batch per model, so thread pool and allocator start-up is not charged to the first one timed
+        classifier.predict(texts[:args.batch_size], features[:args.batch_size] if features is not None else None)
+        start = time.perf_counter()
+        _, timings = classifier.predict(texts, features)
+        report[name] = {"accuracy": metrics["accuracy"], "f1": metrics["f1"],
+                        "parameters": sum(p.numel() for p in model.parameters()),
+                        "cpu": latency_report(timings, time.perf_counter() - start)}
+    report["accuracy_delta"] = report["student"]["accuracy"] - report["teacher"]["accuracy"]
+    report["f1_delta"] = report["student"]["f1"] - report["teacher"]["f1"]
+    report["cpu_speedup"] = report["student"]["cpu"]["flows_per_second"] / report["teacher"]["cpu"]["flows_per_second"]
+    report["cpu_threads"] = torch.get_num_threads()
+    with open(os.path.join(args.output_dir, DISTILL_REPORT_FILE), "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
 if __name__ == "__main__":
     main()    
\ No newline at end of file
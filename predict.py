@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+import pyarrow.parquet as pq
+from transformers import AutoTokenizer
+from main import (load_instruction, load_saved_model, model_num_labels, tokenize_windows, TokenBudgetBatchSampler,
+                  WindowCollator, WindowPoolingModel)
+from preprocess_utils import FEATURE_MATRIX_SUFFIX, FEATURE_STATS_FILE, normalize_features, build_td_text_dataset, load_render_config
+
+def get_args():
+    parser = argparse.ArgumentParser(description="classify flows with a trained model")
+    parser.add_argument("--model_dir", type=str, help="saved model dir, e.g. <output_dir>/final_model", required=True)
+    parser.add_argument("--input", type=str, help="directory of per-flow pcaps, preprocessed dataset dir, or .tsv/.parquet file", required=True)
+    parser.add_argument("--output", type=str, help="predictions csv path", required=True)
+    parser.add_argument("--split", type=str, help="split read from a preprocessed dataset dir", default="test")
+    parser.add_argument("--label_file", type=str, help="label.tsv written by preprocess.py, names the predicted ids", default=None)
+    parser.add_argument("--raw_dir", type=str, help="raw dataset path holding feature/ for pcap input", default=None)
+    parser.add_argument("--task_name", type=str, help="detection task of the instruction for pcap input, e.g. EMD", default="EAC")
+    parser.add_argument("--no_instruction", action="store_true", help="the model was trained without the task instruction")
+    parser.add_argument("--extractor", type=str, choices=["tshark", "native"], default="tshark", help="packet field extractor for pcap input")
+    parser.add_argument("--flow_format", type=str, choices=["verbose", "compact"], default=None, help="flow serialization for pcap input, defaults to the one the model was trained with, else verbose")
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--max_windows", type=int, help="packet windows kept per flow by window pooling models, defaults to the saved one", default=None)
+    parser.add_argument("--max_packets", type=int, help="packets rendered per flow for pcap input, defaults to the one the model was trained with", default=None)
+    parser.add_argument("--window_packets", type=int, help="packets per window for pcap input, defaults to the one the model was trained with", default=None)
+    parser.add_argument("--batch_size", type=int, help="max flows per micro-batch", default=32)
+    parser.add_argument("--max_tokens", type=int, help="cap micro-batches by padded token count as well", default=None)
+    parser.add_argument("--num_threads", type=int, help="intra-op threads", default=os.cpu_count())
+    parser.add_argument("--interop_threads", type=int, help="inter-op threads", default=1)
+    parser.add_argument("--report", type=str, help="json throughput/latency report path", default=None)
+    args = parser.parse_args()
+    return args
+
+class FlowClassifier:
+    """A saved model loaded once for CPU inference over micro-batches of length-sorted flows
+
+    Models trained with numeric features are FeatureFusionModel checkpoints;
+    flows without a feature vector get the train mean (zeros) for them. Window
+    pooling models get the first max_windows packet windows of each flow, by
+    default as many as in training. max_packets, window_packets and flow_format
+    are the rendering of the training flows saved with the model, None for
+    models saved before it was.
+    """
+
+    def __init__(self, model_dir, max_length=512, batch_size=32, max_tokens=None, labels=None, max_windows=None):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = load_saved_model(model_dir).eval()
+        self.fusion = getattr(self.model, "num_features", 0) > 0
+        windowed = isinstance(self.model, WindowPoolingModel)
+        self.max_windows = (max_windows or self.model.max_windows) if windowed else 0
+        render_config = load_render_config(model_dir)
+        self.max_packets = render_config.get("max_packets", self.model.max_packets if windowed else None)
+        self.window_packets = render_config.get("window_packets", self.model.window_packets if windowed else None)
+        self.flow_format = render_config.get("flow_format")
+        self.collator = WindowCollator(self.tokenizer) if self.max_windows else None
+        num_labels = model_num_labels(self.model)
+        self.feature_stats = None
+        if os.path.exists(os.path.join(model_dir, FEATURE_STATS_FILE)):
+            with open(os.path.join(model_dir, FEATURE_STATS_FILE)) as f:
+                self.feature_stats = json.load(f)
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        config_labels = [self.model.config.id2label.get(i, f"LABEL_{i}") for i in range(num_labels)]
+        self.labels = labels or config_labels
+
+    def batches(self, lengths):
+        # sorted by length so each micro-batch is padded to a similar size, see TokenBudgetBatchSampler
+        return TokenBudgetBatchSampler(lengths, self.max_tokens or float("inf"), max_batch_size=self.batch_size).batches
+
+    def predict(self, texts, features=None):
+        """Return (class probabilities in input order, per micro-batch (size, seconds))
+
+        features is the normalized float32 feature matrix of a fusion model, row-aligned with texts.
+        """
+        if self.max_windows:
+            encoded = tokenize_windows(list(texts), self.tokenizer, self.max_length, self.max_windows)
+            lengths = encoded.pop("length")
+        else:
+            encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+            lengths = [len(ids) for ids in encoded["input_ids"]]
+        probs = np.zeros((len(lengths), len(self.labels)), dtype=np.float32)
+        timings = []
+        with torch.inference_mode():
+            for batch in self.batches(lengths):
+                start = time.perf_counter()
+                if self.collator is not None:
+                    inputs = self.collator([{k: encoded[k][i] for k in encoded.keys()} for i in batch])
+                else:
+                    inputs = self.tokenizer.pad({k: [encoded[k][i] for i in batch] for k in encoded.keys()}, return_tensors="pt")
+                if self.fusion and features is not None:
+                    inputs["num_features"] = torch.from_numpy(np.asarray(features[batch], dtype=np.float32))
+                logits = self.model(**inputs).logits
+                probs[batch] = torch.softmax(logits.float(), dim=-1).numpy()
+                timings.append((len(batch), time.perf_counter() - start))
+        return probs, timings
+
+def read_label_names(label_file):
+    labels = pd.read_csv(label_file)
+    return list(labels.sort_values("int")["str"])
+
+def load_dataset_inputs(path, split):
+    """Texts, names, labels and feature matrix of a preprocessed split, the last two when present
+
+    The instruction comes from the Parquet metadata.
+    """
+    if os.path.isdir(path):
+        parquet_path = os.path.join(path, split + ".parquet")
+        path = parquet_path if os.path.exists(parquet_path) else os.path.join(path, split + ".tsv")
+    else:
+        split = os.path.splitext(os.path.basename(path))[0]
+    feature_path = os.path.join(os.path.dirname(path), split + FEATURE_MATRIX_SUFFIX)
+    features = np.load(feature_path) if os.path.exists(feature_path) else None
+    if path.endswith(".parquet"):
+        data = pd.read_parquet(path)
+        instruction = (pq.read_schema(path).metadata or {}).get(b"instruction", b"").decode("utf-8")
+    else:
+        data = pd.read_csv(path)
+        instruction = load_instruction(os.path.dirname(path))
+    names = [str(i) for i in range(len(data))]
+    return [instruction + x for x in data["inputs"]], names, data.get("labels"), features
+
+def load_pcap_inputs(pcap_dir, raw_dir, extractor, flow_format, instruction, feature_stats=None, max_packets=None, window_packets=0):
+    """Render the per-flow pcaps of pcap_dir through the preprocess.py filter and serialization
+
+    With the feature_stats of a fusion model, the CIC features are normalized into a
+    matrix instead of being appended to the text; new traffic usually has no
+    CICFlowMeter CSV, its flows then get no features. max_packets defaults to the
+    preprocess.py one, window_packets > 0 renders packet windows.
+    """
+    from preprocess import chunk_pcap_dir, load_session_stats, process_shard, MAX_PACKET_NUM
+    from flow_features import parse_feature_vector
+
+    pcap_paths = sorted(p for chunk in chunk_pcap_dir(pcap_dir, 1) for p in chunk)
+    with tempfile.TemporaryDirectory() as tmp:
+        flows, _, names, _, _ = process_shard(pcap_paths, raw_dir, load_session_stats(pcap_dir), os.path.join(tmp, "shard.pcap"),
+                                           extractor, flow_format, 'numeric' if feature_stats else 'text',
+                                           max_packets=max_packets or MAX_PACKET_NUM, window_packets=window_packets or 0,
+                                           allow_missing_features=True)
+    print(f"{len(flows)} of {len(pcap_paths)} flows passed the filter")
+    if not feature_stats:
+        return [instruction + flow for flow in flows], names, None, None
+    width = len(feature_stats["columns"])
+    features = normalize_features(np.array([parse_feature_vector(flow[1], width) for flow in flows]).reshape(-1, width), feature_stats)
+    return [instruction + flow[0] for flow in flows], names, None, features
+
+def latency_report(timings, total_seconds):
+    sizes = np.array([size for size, _ in timings])
+    seconds = np.array([s for _, s in timings])
+    per_flow = np.repeat(seconds / sizes, sizes) * 1000
+    return {
+        "flows": int(sizes.sum()),
+        "batches": len(timings),
+        "flows_per_second": float(sizes.sum() / total_seconds),
+        "batch_ms": {p: float(np.percentile(seconds * 1000, int(p[1:]))) for p in ["p50", "p95", "p99"]},
+        "flow_ms": {p: float(np.percentile(per_flow, int(p[1:]))) for p in ["p50", "p95", "p99"]},
+    }
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.num_threads)
+    torch.set_num_interop_threads(args.interop_threads)
+
+    labels = read_label_names(args.label_file) if args.label_file else None
+    start = time.perf_counter()
+    classifier = FlowClassifier(args.model_dir, args.max_length, args.batch_size, args.max_tokens, labels, args.max_windows)
+    print(f"model loaded in {time.perf_counter() - start:.2f}s")
+
+    if os.path.isdir(args.input) and not any(f.endswith(".pcap") for f in os.listdir(args.input)):
+        texts, names, true_labels, features = load_dataset_inputs(args.input, args.split)
+    elif os.path.isdir(args.input):
+        instruction = ""
+        if not args.no_instruction:
+            instruction = build_td_text_dataset([], task_name=args.task_name, granularity='session').attrs["instruction"]
+        raw_dir = args.raw_dir or os.path.dirname(os.path.dirname(os.path.abspath(args.input)))
+        flow_format = args.flow_format or classifier.flow_format or "verbose"
+        texts, names, true_labels, features = load_pcap_inputs(args.input, raw_dir, args.extractor, flow_format, instruction,
+                                                               classifier.feature_stats if classifier.fusion else None,
+                                                               args.max_packets or classifier.max_packets,
+                                                               args.window_packets if args.window_packets is not None else classifier.window_packets)
+    else:
+        texts, names, true_labels, features = load_dataset_inputs(args.input, args.split)
+    if not texts:
+        print("nothing to classify")
+        return
+
+    start = time.perf_counter()
+    probs, timings = classifier.predict(texts, features)
+    report = latency_report(timings, time.perf_counter() - start)
+    print(f"inference: {report}")
+
+    predictions = probs.argmax(axis=1)
+    result = pd.DataFrame({"name": names, "label": [classifier.labels[i] for i in predictions], "label_id": predictions})
+    for i, label in enumerate(classifier.labels):
+        result["prob_" + str(label)] = probs[:, i]
+    if true_labels is not None:
+        result["true_label_id"] = np.asarray(true_labels)
+        report["accuracy"] = float((result["true_label_id"] == result["label_id"]).mean())
+        print(f"accuracy: {report['accuracy']:.4f}")
+    result.to_csv(args.output, index=False)
+    print(f"predictions are saved in: {args.output}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from pathlib import Path
+from pcap_io import read_records, write_pcap
+from synth_data import generate_dataset
+from pcap_to_flow import split_pcap_file
+from flow_features import feature_csv_path, load_feature_index, INDEX_CACHE_SUFFIX
+from flow_data_preprocess import build_flow_data
+from preprocess_utils import build_td_text_dataset
+import preprocess
+
+STAGES = ["split", "filter_flow", "get_session_feature", "build_flow_data", "build_td_text_dataset", "end_to_end"]
+
+def get_args():
+    parser = argparse.ArgumentParser(description="benchmark the preprocessing stages on synthetic captures")
+    parser.add_argument("--data_dir", type=str, help="synthetic raw dataset path, generated when missing, a temp dir by default", default=None)
+    parser.add_argument("--classes", type=int, help="number of classes", default=4)
+    parser.add_argument("--flows", type=int, help="flows per class", default=500)
+    parser.add_argument("--packets", type=int, help="mean packets per flow", default=10)
+    parser.add_argument("--min_payload", type=int, help="min payload bytes", default=0)
+    parser.add_argument("--max_payload", type=int, help="max payload bytes", default=1400)
+    parser.add_argument("--extractor", type=str, choices=["tshark", "native"], default="native", help="packet field extractor")
+    parser.add_argument("--flow_format", type=str, choices=["verbose", "compact"], default="verbose", help="flow serialization")
+    parser.add_argument("--num_workers", type=int, help="workers of the split and end_to_end stages", default=os.cpu_count())
+    parser.add_argument("--stages", type=str, nargs="+", choices=STAGES, default=STAGES, help="stages to run")
+    parser.add_argument("--output", type=str, help="json results path", default=None)
+    parser.add_argument("--baseline", type=str, help="json results of another commit to compare with", default=None)
+    args = parser.parse_args()
+    return args
+
+def reset_peak_rss():
+    # Linux only: resets VmHWM of this process, so every stage reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def class_dirs(data_dir):
+    return sorted(d for d in Path(data_dir, "flow").iterdir() if d.is_dir())
+
+def clear_feature_cache(data_dir):
+    load_feature_index.cache_clear()
+    for path in Path(data_dir, "feature").glob("*" + INDEX_CACHE_SUFFIX):
+        path.unlink()
+
+def run_stage(stage, data_dir, args, state):
+    """Run one stage, returns (flows, input bytes)"""
+    if stage == "split":
+        split_pcap_file(data_dir, args.num_workers)
+        captures = list(Path(data_dir).glob("*.pcap"))
+        return sum(len(list(d.glob("*.pcap"))) for d in class_dirs(data_dir)), sum(p.stat().st_size for p in captures)
+    if stage == "filter_flow":
+        state["filtered"] = []
+        size = 0
+        for d in class_dirs(data_dir):
+            pcap_paths = list(d.glob("*.pcap"))
+            size += sum(p.stat().st_size for p in pcap_paths)
+            packets, pnum, _, fp = preprocess.filter_flow(pcap_paths, data_dir, preprocess.load_session_stats(str(d)), args.flow_format)
+            state["filtered"].append((d.name, packets, pnum, fp))
+        return sum(len(fp) for _, _, _, fp in state["filtered"]), size
+    if stage == "get_session_feature":
+        clear_feature_cache(data_dir)
+        state["features"] = [preprocess.get_session_feature(fp, data_dir, args.flow_format) for _, _, _, fp in state["filtered"]]
+        csv_paths = {feature_csv_path(data_dir, p.name) for _, _, _, fp in state["filtered"] for p in fp}
+        return sum(len(f) for f in state["features"]), sum(os.path.getsize(p) for p in csv_paths if os.path.exists(p))
+    if stage == "build_flow_data":
+        state["build_data"] = []
+        size = 0
+        for (name, packets, pnum, _), features in zip(state["filtered"], state["features"]):
+            shard = state["shards"][name]
+            size += os.path.getsize(shard)
+            state["build_data"].append(build_flow_data(shard, pnum, features, args.extractor, progress=False, flow_format=args.flow_format))
+        return sum(len(b) for b in state["build_data"]), size
+    if stage == "build_td_text_dataset":
+        size = 0
+        flows = 0
+        for i, build_data in enumerate(state["build_data"]):
+            size += sum(len(flow) for flow in build_data)
+            flows += len(build_td_text_dataset(build_data, int_label=i, str_label=str(i), task_name="EAC", granularity='session'))
+        return flows, size
+    if stage == "end_to_end":
+        output_path = os.path.join(state["tmp"], "dataset")
+        argv = sys.argv
+        sys.argv = ["preprocess.py", "--input", data_dir, "--dataset_name", "bench", "--output_path", output_path,
+                    "--num_workers", str(args.num_workers), "--extractor", args.extractor,
+                    "--flow_format", args.flow_format, "--no_cache"]
+        try:
+            preprocess.main()
+        finally:
+            sys.argv = argv
+        flows = sum(1 for _ in open(os.path.join(output_path, "data.tsv"), encoding='utf-8')) - 1
+        return flows, sum(p.stat().st_size for d in class_dirs(data_dir) for p in d.glob("*.pcap"))
+
+def prepare_shards(state, tmp):
+    # the shard pcaps build_flow_data reads, written outside of the timed stages
+    state["shards"] = {}
+    for name, packets, _, fp in state["filtered"]:
+        state["shards"][name] = os.path.join(tmp, name + ".pcap")
+        datalink = read_records(str(fp[0]), 0)[0] if fp else 1
+        write_pcap(state["shards"][name], [preprocess.truncate_payload(r, datalink) for r in packets], datalink)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    args = get_args()
+    tmp = tempfile.mkdtemp(prefix="bench_preprocess_")
+    data_dir = args.data_dir or os.path.join(tmp, "raw")
+    if not os.path.exists(os.path.join(data_dir, "feature")):
+        generate_dataset(data_dir, args.classes, args.flows, args.packets, args.min_payload, args.max_payload)
+
+    stages = [s for s in STAGES if s in args.stages]
+    # later stages need the output of earlier ones, which then run untimed
+    needed = set(stages)
+    if needed & {"filter_flow", "get_session_feature", "build_flow_data", "build_td_text_dataset", "end_to_end"} \
+            and not os.path.exists(os.path.join(data_dir, "flow")):
+        needed.add("split")
+    if needed & {"get_session_feature", "build_flow_data", "build_td_text_dataset"}:
+        needed.add("filter_flow")
+    if needed & {"build_flow_data", "build_td_text_dataset"}:
+        needed.add("get_session_feature")
+    if "build_td_text_dataset" in needed:
+        needed.add("build_flow_data")
+
+    state = {"tmp": tmp}
+    results = {}
+    try:
+        for stage in STAGES:
+            if stage not in needed:
+                continue
+            if stage == "build_flow_data":
+                prepare_shards(state, tmp)
+            reset_peak_rss()
+            children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            start = time.perf_counter()
+            flows, size = run_stage(stage, data_dir, args, state)
+            seconds = time.perf_counter() - start
+            if stage not in stages:
+                continue
+            peak = peak_rss_mb()
+            # worker processes only show up as the largest child, which is the best getrusage offers
+            workers_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            results[stage] = {
+                "seconds": seconds, "flows": flows, "bytes": size,
+                "flows_per_second": flows / seconds if seconds else 0.0,
+                "mb_per_second": size / 1e6 / seconds if seconds else 0.0,
+                "peak_rss_mb": peak,
+                "peak_child_rss_mb": workers_peak if workers_peak > children_rss else None,
+            }
+            print(f"{stage}: {results[stage]}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "cpu_count": multiprocessing.cpu_count(),
+        "params": {k: getattr(args, k) for k in ["classes", "flows", "packets", "min_payload", "max_payload",
+                                                 "extractor", "flow_format", "num_workers"]},
+        "stages": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+        for stage, result in results.items():
+            if stage in baseline and baseline[stage]["flows_per_second"]:
+                result["speedup"] = result["flows_per_second"] / baseline[stage]["flows_per_second"]
+                print(f"{stage}: {result['speedup']:.2f}x flows/s vs baseline")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import socket
+import argparse
+import numpy as np
+import dpkt
+from packet_fields import FieldExtractor
+from flow_data_preprocess import render_flow, render_flow_compact
+from flow_dedup import FlowDeduplicator, flow_signatures, packet_text
+
+def get_args():
+    parser = argparse.ArgumentParser(description="check that --dedup removes flows differing only in capture time and client port")
+    parser.add_argument("--flows", type=int, help="repeated DNS flows, followed by as many distinct ones", default=60)
+    parser.add_argument("--threshold", type=float, help="near duplicate threshold", default=0.9)
+    parser.add_argument("--minhash_perm", type=int, help="MinHash signature length", default=64)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+    return args
+
+def dns_frame(src, dst, sport, dport, payload):
+    udp = dpkt.udp.UDP(sport=sport, dport=dport, data=payload)
+    udp.ulen = 8 + len(payload)
+    ip = dpkt.ip.IP(src=socket.inet_aton(src), dst=socket.inet_aton(dst), p=dpkt.ip.IP_PROTO_UDP, ttl=64, data=udp)
+    ip.len = len(ip)
+    return bytes(dpkt.ethernet.Ethernet(src=b'\x00\x11\x22\x33\x44\x55', dst=b'\x66\x77\x88\x99\xaa\xbb',
+                                        type=dpkt.ethernet.ETH_TYPE_IP, data=ip))
+
+def dns_flows(rng, flows, repeated=True):
+    """(ts, frame) packets of query/response flows; repeated ones only differ in client port and times"""
+    result = []
+    ts = 1700000000.0
+    for i in range(flows):
+        query = b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'
+        if not repeated:
+            query = rng.bytes(len(query))
+        sport = int(rng.randint(1024, 65536))
+        ts += float(rng.exponential(1.0))
+        result.append([(ts, dns_frame("10.0.0.2", "10.0.0.53", sport, 53, query)),
+                       (ts + float(rng.exponential(0.02)), dns_frame("10.0.0.53", "10.0.0.2", 53, sport, query + b'\xc0\x0c' * 8))])
+    return result
+
+def render_shard(flows, render):
+    # one extractor over all flows, as a worker renders its shard: frame.time_relative grows from flow to flow
+    extractor = FieldExtractor(dpkt.pcap.DLT_EN10MB)
+    return [render([extractor.extract(ts, buf, len(buf)) for ts, buf in packets], "") for packets in flows]
+
+def removed(texts, num_perm, threshold):
+    dedup = FlowDeduplicator(num_perm, threshold)
+    kept = [dedup.add(digest, signature) for digest, signature in flow_signatures([packet_text(t) for t in texts], num_perm)]
+    return len(texts) - sum(kept), dedup.removed
+
+def main():
+    args = get_args()
+    rng = np.random.RandomState(args.seed)
+    repeated = dns_flows(rng, args.flows)
+    distinct = dns_flows(rng, args.flows, repeated=False)
+    ok = True
+    for flow_format, render in [("verbose", render_flow), ("compact", render_flow_compact)]:
+        for mode, num_perm in [("exact", 0), ("near", args.minhash_perm)]:
+            count, kinds = removed(render_shard(repeated, render), num_perm, args.threshold)
+            distinct_count, _ = removed(render_shard(distinct, render), num_perm, args.threshold)
+            passed = count == args.flows - 1 and distinct_count == 0
+            ok = ok and passed
+            print(f"{flow_format} {mode}: {count}/{args.flows - 1} repeated flows removed {kinds}, "
+                  f"{distinct_count} distinct flows removed, {'ok' if passed else 'FAILED'}")
+    if not ok:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
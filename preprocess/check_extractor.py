@@ -0,0 +1,51 @@
+import argparse
+from collections import Counter
+from pathlib import Path
+import dpkt
+from flow_data_preprocess import tshark_flow_fields
+from packet_fields import iter_flow_fields
+
+def get_args():
+    parser = argparse.ArgumentParser(description="compare the native packet field extractor with tshark")
+    parser.add_argument("--input", type=str, help="pcap file or directory of per-flow pcaps", required=True)
+    parser.add_argument("--limit", type=int, help="max number of pcaps to compare", default=100)
+    args = parser.parse_args()
+    return args
+
+def count_packets(pcap):
+    with open(str(pcap), 'rb') as f:
+        return sum(1 for _ in dpkt.pcap.Reader(f))
+
+def compare_pcap(pcap, mismatches, examples):
+    pnums = [count_packets(pcap)]
+    native = next(iter_flow_fields(str(pcap), pnums))
+    tshark = next(tshark_flow_fields(str(pcap), pnums))
+    for i, (n_packet, t_packet) in enumerate(zip(native, tshark)):
+        n_values = dict(n_packet)
+        t_values = {field: value for field, value in t_packet if value != ""}
+        for field in n_values.keys() | t_values.keys():
+            if n_values.get(field) != t_values.get(field):
+                mismatches[field] += 1
+                examples.setdefault(field, (pcap.name, i, n_values.get(field), t_values.get(field)))
+    return len(native)
+
+def main():
+    args = get_args()
+    path = Path(args.input)
+    pcaps = sorted(path.glob('*.pcap'))[:args.limit] if path.is_dir() else [path]
+
+    mismatches = Counter()
+    examples = {}
+    packets = 0
+    for pcap in pcaps:
+        packets += compare_pcap(pcap, mismatches, examples)
+
+    print(f"Compared {len(pcaps)} pcaps, {packets} packets")
+    if not mismatches:
+        print("native extractor matches tshark on every field")
+    for field, count in mismatches.most_common():
+        name, idx, native_value, tshark_value = examples[field]
+        print(f"{field}: {count} mismatches, e.g. {name}#{idx} native={native_value!r} tshark={tshark_value!r}")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
 from flowcontainer.extractor import extract
+import itertools
+import resource
 import subprocess
 from tqdm import tqdm
+from packet_fields import FIELDS, iter_flow_fields
+from flow_features import quantize
+from stage_metrics import METRICS
+from preprocess_utils import WINDOW_SEP
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -9,28 +15,38 @@ MAX_PACKET_LENGTH = 1024
 MAX_PAYLOAD_LENGTH = 128
 HEX_PACKET_START_INDEX = 0  # 0 # 48 # 76
 
-def build_flow_data(pcap_file, pnums, features):
-    # fields selected by gemini 2.5 Pro
-    fields = [
-            # Frame-level information (useful for timing, length, and overall protocol stack)
-            "frame.time_delta", "frame.time_relative", "frame.len", "frame.protocols",
-            # IP-level information (crucial for addressing, protocol, QoS, fragmentation flags, TTL)
-            "ip.version", "ip.hdr_len", "ip.dsfield", "ip.dsfield.dscp", "ip.dsfield.ecn", "ip.len",
-            "ip.flags", "ip.flags.df", "ip.flags.mf", "ip.ttl", "ip.proto",
-            # TCP-level information (ports, segment length, header length, flags, window size, timing, analysis, payload)
-            "tcp.srcport", "tcp.dstport", "tcp.len", "tcp.hdr_len", "tcp.flags",
-             "tcp.flags.cwr", "tcp.flags.urg", "tcp.flags.ack", "tcp.flags.push",
-            "tcp.flags.reset", "tcp.flags.syn", "tcp.flags.fin", "tcp.flags.str",
-            "tcp.window_size", "tcp.time_relative", "tcp.time_delta",
-            "tcp.analysis.bytes_in_flight", "tcp.analysis.push_bytes_sent", "tcp.reassembled.length",
-            # TLS-level information (very useful for encrypted traffic identification)
-            "tls.record.content_type", "tls.record.version", "tls.record.length",
-            "tcp.payload",
-            # UDP-level information (ports, length)
-            "udp.srcport", "udp.dstport", "udp.length", "udp.time_relative", "udp.time_delta", "udp.payload"]
-        
-        # tshark 3.6.16
-    # ...existing code...
+# compact format: (code, fields, default) in output order, a value equal to the default is omitted.
+# Per-flow inter-arrival time replaces the capture-relative frame times, fields implied by
+# another one (ip.len, ip.flags, ip.proto, the tcp.flags.* booleans) are dropped.
+COMPACT_FIELDS = [
+    ("dt", ["tcp.time_delta", "udp.time_delta"], "0"),
+    ("len", ["frame.len"], None),
+    ("pr", ["frame.protocols"], None),
+    ("v", ["ip.version"], "4"),
+    ("hl", ["ip.hdr_len"], "20"),
+    ("ds", ["ip.dsfield.dscp"], "0"),
+    ("ecn", ["ip.dsfield.ecn"], "0"),
+    ("df", ["ip.flags.df"], "0"),
+    ("mf", ["ip.flags.mf"], "0"),
+    ("ttl", ["ip.ttl"], None),
+    ("sp", ["tcp.srcport", "udp.srcport"], None),
+    ("dp", ["tcp.dstport", "udp.dstport"], None),
+    ("tl", ["tcp.len", "udp.length"], None),
+    ("th", ["tcp.hdr_len"], "20"),
+    ("f", ["tcp.flags.str"], ""),
+    ("win", ["tcp.window_size"], None),
+    ("bif", ["tcp.analysis.bytes_in_flight"], None),
+    ("pbs", ["tcp.analysis.push_bytes_sent"], None),
+    ("rl", ["tcp.reassembled.length"], None),
+    ("ct", ["tls.record.content_type"], None),
+    ("tv", ["tls.record.version"], None),
+    ("rlen", ["tls.record.length"], None),
+    ("pl", ["tcp.payload", "udp.payload"], None),
+]
+PROTOCOL_PREFIXES = ("eth:ethertype:", "sll:ethertype:", "raw:", "null:")
+
+def tshark_flow_fields(pcap_file, pnums, fields=FIELDS):
+    """Yield the (field, value) pairs of each flow as dissected by tshark"""
     # tshark 4
     # fields = ["frame.encap_type", "frame.time", "frame.offset_shift", "frame.time_epoch", "frame.time_delta",
     #             "frame.time_relative", "frame.number", "frame.len", "frame.marked", "frame.protocols", "eth.dst",
@@ -77,32 +93,96 @@ def build_flow_data(pcap_file, pnums, features):
     #           "tcp.segment.count", "tcp.reassembled.length", "tcp.payload", "udp.srcport", "udp.dstport", "udp.length",
     #           "udp.checksum", "udp.checksum.status", "udp.stream", "data.len"]
 
-    extract_str = "-e " + " -e ".join(fields)
-    cmd = ['tshark', '-r', pcap_file, '-T', 'fields', extract_str]
-    cmd = ' '.join(cmd)
-    lines = subprocess.run(cmd, capture_output=True, text=True, check=True, encoding='utf-8').stdout.splitlines()
+    cmd = ['tshark', '-r', pcap_file, '-T', 'fields']
+    for field in fields:
+        cmd += ['-e', field]
+    # read tshark's output incrementally instead of buffering the whole dissection
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, encoding='utf-8') as proc:
+        for n in pnums:
+            with METRICS.stage("tshark_read"):
+                flow = list(itertools.islice(proc.stdout, n))
+            yield [list(zip(fields, packet.strip().split("\t"))) for packet in flow]
+    finished = resource.getrusage(resource.RUSAGE_CHILDREN)
+    METRICS.add_time("tshark_cpu", finished.ru_utime + finished.ru_stime - usage.ru_utime - usage.ru_stime)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
 
-    build_data = []
-    current_idx = 0
-    
-    for n, feature in tqdm(zip(pnums, features), total=len(pnums)):
-        flow = lines[current_idx : current_idx + n]
-        flow_data = ''
-        for packet in flow:
-            packet_data = ""
-            values = packet.strip().split("\t")
-            for field, value in zip(fields, values):
-                if value == "":
-                    continue
-                # if field == "tcp.flags.str" and "\\\\" in value:
-                #     value = value.encode("unicode_escape").decode("unicode_escape")
-                if field == "tcp.payload" or field == "udp.payload":
-                    value = value[:MAX_PAYLOAD_LENGTH] if len(value) > MAX_PAYLOAD_LENGTH else value
-                packet_data += field + ": " + value +  ", "
-            packet_data = packet_data[:-2]
-            flow_data += '<pck>' + packet_data +  ' '
+def render_flow(flow, feature):
+    flow_data = ''
+    for packet in flow:
+        packet_data = ""
+        for field, value in packet:
+            if value == "":
+                continue
+            # if field == "tcp.flags.str" and "\\\\" in value:
+            #     value = value.encode("unicode_escape").decode("unicode_escape")
+            if field == "tcp.payload" or field == "udp.payload":
+                value = value[:MAX_PAYLOAD_LENGTH] if len(value) > MAX_PAYLOAD_LENGTH else value
+            packet_data += field + ": " + value +  ", "
+        packet_data = packet_data[:-2]
+        flow_data += '<pck>' + packet_data +  ' '
+    if feature is not None:
         flow_data += '\\n<feature>' + feature
-        build_data.append(flow_data)
-        current_idx += n
+    return flow_data
+
+def compact_value(code, value):
+    if code == "dt":
+        # seconds -> milliseconds, 3 significant digits
+        return quantize(float(value) * 1000)
+    if code == "pr":
+        for prefix in PROTOCOL_PREFIXES:
+            if value.startswith(prefix):
+                return value[len(prefix):]
+        return value
+    if code == "f":
+        return value.replace("·", "")
+    if code == "pl":
+        return value[:MAX_PAYLOAD_LENGTH]
+    return value
+
+def render_flow_compact(flow, feature):
+    """Token-efficient rendering: short field codes in a fixed order, defaults omitted and times quantized"""
+    packets = []
+    for packet in flow:
+        values = {field: value for field, value in packet if value != ""}
+        parts = []
+        for code, fields, default in COMPACT_FIELDS:
+            value = next((values[field] for field in fields if field in values), None)
+            if value is None:
+                continue
+            value = compact_value(code, value)
+            if value != default:
+                parts.append(code + ":" + value)
+        packets.append('<pck>' + " ".join(parts))
+    if feature is None:
+        return " ".join(packets)
+    return " ".join(packets) + ' <feature>' + feature
+
+def render_windows(render, flow, feature, window_packets):
+    """Render a flow as consecutive windows of window_packets packets joined by WINDOW_SEP, the feature ends the last one"""
+    windows = [flow[i:i + window_packets] for i in range(0, len(flow), window_packets)] or [flow]
+    return WINDOW_SEP.join(render(window, feature if i == len(windows) - 1 else None) for i, window in enumerate(windows))
+
+def build_flow_data(pcap_file, pnums, features, extractor='tshark', progress=True, flow_format='verbose', window_packets=0):
+    """Render every flow of pcap_file, pnums gives the number of packets of each consecutive flow.
+
+    extractor='tshark' dissects the capture with an external tshark process,
+    extractor='native' decodes the same fields in-process with dpkt while streaming the file.
+    flow_format='compact' uses render_flow_compact instead of the verbose "field: value" text.
+    window_packets > 0 renders each flow as windows of that many packets, see render_windows.
+    """
+    if extractor == 'native':
+        flows = iter_flow_fields(pcap_file, pnums)
+    else:
+        flows = tshark_flow_fields(pcap_file, pnums)
+
+    render = render_flow_compact if flow_format == 'compact' else render_flow
+    build_data = []
+    for flow, feature in tqdm(zip(flows, features), total=len(pnums), disable=not progress):
+        if window_packets:
+            build_data.append(render_windows(render, flow, feature, window_packets))
+        else:
+            build_data.append(render(flow, feature))
 
     return build_data
\ No newline at end of file
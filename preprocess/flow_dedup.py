@@ -0,0 +1,154 @@
+import zlib
+import hashlib
+import numpy as np
+from stage_metrics import METRICS
+
+SHINGLE_TOKENS = 5  # whitespace tokens per MinHash shingle
+SIGNATURE_CHUNK = 2048  # flows signed at once when the workers did not sign them
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# capture dependent fields, verbose names and compact codes (see COMPACT_FIELDS): times relative to the
+# shard start or to the previous packet are dropped, the ephemeral client port is masked
+TIME_FIELDS = {"frame.time_delta", "frame.time_relative", "tcp.time_relative", "tcp.time_delta",
+               "udp.time_relative", "udp.time_delta", "dt"}
+SRC_PORT_FIELDS = ("tcp.srcport", "udp.srcport", "sp")
+PORT_FIELDS = {"tcp.srcport", "tcp.dstport", "udp.srcport", "udp.dstport", "sp", "dp"}
+WINDOW_MARK = "<window>"
+
+def packet_text(flow):
+    """Packet portion of a rendered flow, without the CIC feature suffix of either flow format"""
+    text = flow[0] if isinstance(flow, list) else flow
+    return text.split('<feature>', 1)[0].rstrip(' \\n')
+
+def parse_packet(packet):
+    """(field, value) pairs of one rendered packet, "field: value, ..." verbose or "code:value ..." compact"""
+    if ": " in packet:
+        return [item.partition(": ")[::2] for item in packet.split(", ")]
+    return [item.partition(":")[::2] for item in packet.split()]
+
+def normalize_packets(text):
+    """One "field=value ..." string per packet of a packet text, without the times and with the client port masked
+
+    The client port is the source port of the first packet, so both directions
+    of the flow mask it.
+    """
+    packets = [parse_packet(p.strip()) for p in text.replace(WINDOW_MARK, " ").split("<pck>") if p.strip()]
+    client_port = next((value for field, value in packets[0] if field in SRC_PORT_FIELDS), None) if packets else None
+    return [" ".join(f"{field}={'*' if field in PORT_FIELDS and value == client_port else value}"
+                     for field, value in packet if field not in TIME_FIELDS)
+            for packet in packets]
+
+def minhash_permutations(num_perm, seed=1):
+    rng = np.random.RandomState(seed)
+    return (rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64),
+            rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64))
+
+def lsh_bands(threshold, num_perm):
+    """(bands, rows) splitting the signature so that the LSH collision curve (1/bands)^(1/rows) is closest to threshold"""
+    shapes = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(shapes, key=lambda shape: abs((1 / shape[0]) ** (1 / shape[1]) - threshold))
+
+def flow_signatures(texts, num_perm=0):
+    """(exact digest, MinHash signature or None) of every packet text, run in the pool workers
+
+    Both are computed over the normalize_packets fields, so flows that only differ in
+    capture times and client port are exact duplicates. Shingles are hashed with
+    crc32 rather than hash(), whose seed differs between processes.
+    """
+    permutations = minhash_permutations(num_perm) if num_perm else None
+    signatures = []
+    for text in texts:
+        packets = normalize_packets(text)
+        digest = hashlib.blake2b("\n".join(packets).encode('utf-8'), digest_size=16).digest()
+        if permutations is None:
+            signatures.append((digest, None))
+            continue
+        tokens = " ".join(packets).split()
+        shingles = {' '.join(tokens[i:i + SHINGLE_TOKENS]) for i in range(max(len(tokens) - SHINGLE_TOKENS + 1, 1))}
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64)
+        a, b = permutations
+        signature = (((hashes[:, None] * a + b) % MERSENNE_PRIME) & MAX_HASH).min(axis=0).astype(np.uint32)
+        signatures.append((digest, signature))
+    return signatures
+
+class FlowDeduplicator:
+    """Keep the first flow of every duplicate group, in the order flows are added.
+
+    Exact duplicates share the digest of their normalized packets. With num_perm > 0, near
+    duplicates are candidates from a banded MinHash LSH index whose estimated Jaccard
+    similarity with a kept flow reaches threshold. Only the kept flows are indexed, so
+    memory grows with the distinct flows of a class.
+    """
+
+    def __init__(self, num_perm=0, threshold=0.9):
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.digests = set()
+        self.bands, self.rows = lsh_bands(threshold, num_perm) if num_perm else (0, 0)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.kept = []
+        self.removed = {"exact": 0, "near": 0}
+        self.removed_chars = 0
+
+    def band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def duplicate_of(self, digest, signature):
+        """Kind of duplicate the flow is, "exact", "near" or None"""
+        if digest in self.digests:
+            return "exact"
+        if signature is None:
+            return None
+        candidates = {i for band, key in zip(self.buckets, self.band_keys(signature)) for i in band.get(key, ())}
+        for i in candidates:
+            if (self.kept[i] == signature).mean() >= self.threshold:
+                return "near"
+        return None
+
+    def add(self, digest, signature, chars=0):
+        """Index the flow and return True when it is kept, count it as removed otherwise"""
+        kind = self.duplicate_of(digest, signature)
+        if kind is not None:
+            self.removed[kind] += 1
+            self.removed_chars += chars
+            return False
+        self.digests.add(digest)
+        if signature is not None:
+            for band, key in zip(self.buckets, self.band_keys(signature)):
+                band.setdefault(key, []).append(len(self.kept))
+            self.kept.append(signature)
+        return True
+
+def iter_signatures(flows, num_perm=0):
+    """flow_signatures of flows, computed one SIGNATURE_CHUNK at a time as they are consumed"""
+    for i in range(0, len(flows), SIGNATURE_CHUNK):
+        yield from flow_signatures([packet_text(flow) for flow in flows[i:i + SIGNATURE_CHUNK]], num_perm)
+
+def dedup_flows(groups, signatures=None, mode="exact", threshold=0.9, num_perm=64):
+    """Drop the duplicates of every group of flows of a class, the groups in order sharing one index.
+
+    groups are the flow lists of one class, e.g. [all flows] before split_dataset or the
+    already sampled [train, val, test]: a flow is dropped when it duplicates a flow kept
+    earlier in its own group or in a previous one, so a duplicate group never spans two
+    splits. signatures holds the flow_signatures of each group, row-aligned, as computed
+    by the workers while rendering the flows (see preprocess.process_shard); a group
+    without them, e.g. of a cached class, is signed here chunk by chunk.
+    mode is "exact" or "near"; returns the deduplicated groups and the deduplicator.
+    """
+    dedup = FlowDeduplicator(num_perm if mode == "near" else 0, threshold)
+    signatures = signatures or [None] * len(groups)
+    result = []
+    with METRICS.stage("dedup_flows"):
+        for flows, group_signatures in zip(groups, signatures):
+            if group_signatures is None:
+                group_signatures = iter_signatures(flows, dedup.num_perm)
+            result.append([flow for flow, (digest, signature) in zip(flows, group_signatures)
+                           if dedup.add(digest, signature, len(flow[0] if isinstance(flow, list) else flow))])
+    METRICS.count("flows_duplicate_exact", dedup.removed["exact"])
+    METRICS.count("flows_duplicate_near", dedup.removed["near"])
+    METRICS.count("chars_duplicate", dedup.removed_chars)
+    return result, dedup
+
+def signature_perm(mode, num_perm=64):
+    """num_perm of the flow_signatures of a --dedup mode, None when flows are not deduplicated"""
+    return None if mode == "none" else (num_perm if mode == "near" else 0)
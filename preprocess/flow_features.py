@@ -0,0 +1,126 @@
+import os
+import functools
+import numpy as np
+import pandas as pd
+
+EXCLUDE_COLUMNS = {'Flow ID', 'Src IP', 'Src Port', 'Dst IP', 'Dst Port', 'Protocol', 'Timestamp', 'Flow Duration', 'Label'}
+INDEX_CACHE_SUFFIX = '.parquet'
+FEATURE_INDEX_CACHE = 4  # feature indexes cached per process
+
+def quantize(value, digits=3):
+    """Compact numeric rendering: integers as is, other numbers to a few significant digits"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    if number != number or number in (float('inf'), float('-inf')):
+        return str(number)
+    if number.is_integer() and abs(number) < 1e15:
+        return str(int(number))
+    return f"{number:.{digits}g}"
+
+def feature_columns(csv_path):
+    """The CICFlowMeter statistics columns of csv_path in file order, read from the header only"""
+    columns = pd.read_csv(csv_path, encoding='gbk', nrows=0).columns
+    return [col for col in columns if col not in EXCLUDE_COLUMNS]
+
+def parse_feature_vector(feature, width):
+    """float32 vector of a numeric feature string, all nan for a flow without a CSV row"""
+    if not feature:
+        return np.full(width, np.nan, dtype=np.float32)
+    vector = np.array(feature.split(" "), dtype=np.float32)
+    if len(vector) != width:
+        raise ValueError(f"feature vector has {len(vector)} values, expected {width}: the feature CSVs have different columns")
+    return vector
+
+def feature_csv_path(input, pcap_name):
+    # BitTorrent.pcap.TCP_1-1-0-12_49252_1-2-7-170_443.pcap -> feature/BitTorrent.pcap_Flow.csv
+    parts = pcap_name.split('.')
+    return os.path.join(input, 'feature', parts[0] + '.' + parts[1] + '_Flow.csv')
+
+def canonical_flow_id(sip, dip, sport, dport, proto):
+    """CICFlowMeter Flow ID with the endpoints ordered, so both directions share one key"""
+    if (sip, sport) > (dip, dport):
+        sip, dip, sport, dport = dip, sip, dport, sport
+    return f"{sip}-{dip}-{sport}-{dport}-{proto}"
+
+def session_five_tuple(pcap_name):
+    """(proto, sip, sport, dip, dport) of a SplitCap style session name, proto as the IP protocol number"""
+    parts = pcap_name.split('.')
+    five_tuple = parts[2].split('_')
+    proto = '6' if five_tuple[0] == 'TCP' else '17'
+    sip = five_tuple[1].replace('-', '.')
+    sport = five_tuple[2]
+    dip = five_tuple[3].replace('-', '.')
+    dport = five_tuple[4]
+    return proto, sip, sport, dip, dport
+
+def session_flow_id(pcap_name):
+    proto, sip, sport, dip, dport = session_five_tuple(pcap_name)
+    return canonical_flow_id(sip, dip, sport, dport, proto)
+
+def build_feature_index(csv_path, flow_format='verbose'):
+    """Render the feature string of every flow of a CICFlowMeter CSV, keyed by canonical Flow ID
+
+    The verbose format is "col: value, ..."; the compact one only lists the quantized
+    values, space separated, in the fixed column order of the CSV. The numeric one lists
+    the float32 values, with inf and unparsable ones as nan, for parse_feature_vector.
+    """
+    data = pd.read_csv(csv_path, encoding='gbk')
+    ids = data['Flow ID'].astype(str).str.split('-', n=4, expand=True)
+    flow_ids = [canonical_flow_id(*row) for row in ids.itertuples(index=False)]
+
+    feature_columns = [col for col in data.columns if col not in EXCLUDE_COLUMNS]
+    features = pd.Series("", index=data.index)
+    for i, col in enumerate(feature_columns):
+        if flow_format == 'numeric':
+            values = pd.to_numeric(data[col], errors='coerce').astype(np.float32).replace([np.inf, -np.inf], np.nan)
+            part = values.astype(str)
+            features = part if i == 0 else features + " " + part
+        elif flow_format == 'compact':
+            part = data[col].map(quantize)
+            features = part if i == 0 else features + " " + part
+        else:
+            part = col + ": " + data[col].astype(str)
+            features = part if i == 0 else features + ", " + part
+
+    index = pd.DataFrame({'flow_id': flow_ids, 'feature': features})
+    # the first row of a Flow ID wins, in either direction
+    return index.drop_duplicates('flow_id', keep='first')
+
+def feature_index_cache_path(csv_path, flow_format='verbose'):
+    return os.path.splitext(csv_path)[0] + ('' if flow_format == 'verbose' else '.' + flow_format) + INDEX_CACHE_SUFFIX
+
+def update_feature_index_cache(csv_path, flow_format='verbose'):
+    """Build the Parquet cache of the feature index of csv_path when it is missing or older than the CSV
+
+    Returns the built index, or None when the cache is up to date. The cache is written
+    to a temporary file and renamed, so other processes never read a partial one; it is
+    skipped when no Parquet engine is installed.
+    """
+    cache_path = feature_index_cache_path(csv_path, flow_format)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+        return None
+    index = build_feature_index(csv_path, flow_format)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        index.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except ImportError:
+        pass
+    return index
+
+@functools.lru_cache(maxsize=FEATURE_INDEX_CACHE)
+def load_feature_index(csv_path, flow_format='verbose'):
+    """Return {canonical Flow ID: feature string} for csv_path, read from its Parquet cache.
+
+    Only the last FEATURE_INDEX_CACHE indexes stay cached in a process, about the
+    captures of the classes a pool worker is rendering.
+    """
+    index = update_feature_index_cache(csv_path, flow_format)
+    if index is None:
+        try:
+            index = pd.read_parquet(feature_index_cache_path(csv_path, flow_format))
+        except ImportError:
+            index = build_feature_index(csv_path, flow_format)
+    return dict(zip(index['flow_id'], index['feature']))
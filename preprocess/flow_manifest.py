@@ -0,0 +1,77 @@
+import os
+import csv
+from pcap_io import scan_pcap
+from flow_features import session_five_tuple
+
+FLOW_MANIFEST_FILE = "flow_manifest.csv"
+FLOW_MANIFEST_COLUMNS = ["name", "size", "mtime_ns", "datalink", "packets", "first_ts", "last_ts",
+                         "proto", "sip", "sport", "dip", "dport"]
+MIN_FLOW_BYTES = 2 * 1024
+MIN_FLOW_PACKETS = 3
+
+def scan_flow_file(p):
+    """Manifest row of one per-session pcap, from its record headers and its file name"""
+    stat = p.stat()
+    datalink, packets, first_ts, last_ts = scan_pcap(str(p))
+    try:
+        five_tuple = session_five_tuple(p.name)
+    except IndexError:
+        five_tuple = ("", "", "", "", "")
+    return dict(zip(FLOW_MANIFEST_COLUMNS, [p.name, stat.st_size, stat.st_mtime_ns, datalink, packets,
+                                            first_ts, last_ts, *five_tuple]))
+
+def scan_flows(pcap_paths, manifest=None):
+    """Manifest rows of pcap_paths, rescanning only the files whose size or mtime changed"""
+    manifest = manifest or {}
+    rows = []
+    for p in pcap_paths:
+        row = manifest.get(p.name)
+        if row is not None:
+            stat = p.stat()
+            if row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+                rows.append(row)
+                continue
+        rows.append(scan_flow_file(p))
+    return rows
+
+def _parse_row(row):
+    for col in ["size", "mtime_ns", "datalink", "packets"]:
+        row[col] = int(row[col])
+    for col in ["first_ts", "last_ts"]:
+        row[col] = float(row[col]) if row[col] else None
+    return row
+
+def load_flow_manifest(pcap_dir):
+    """{pcap name: row} of the manifest of a class directory, empty when there is none"""
+    path = os.path.join(pcap_dir, FLOW_MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row["name"]: _parse_row(row) for row in csv.DictReader(f)}
+
+def save_flow_manifest(pcap_dir, rows):
+    path = os.path.join(pcap_dir, FLOW_MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FLOW_MANIFEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(sorted(rows, key=lambda row: row["name"]))
+    os.replace(tmp_path, path)
+
+def skip_reason(row, session_stats=None):
+    """Why filter_flow drops a flow, None when it is kept.
+
+    The full session size and packet count recorded by pcap_to_flow take precedence
+    over the ones of the possibly truncated session pcap.
+    """
+    packets, size = (session_stats or {}).get(row["name"], (row["packets"], row["size"]))
+    if size < MIN_FLOW_BYTES:
+        return "files_skipped_size"
+    if packets < MIN_FLOW_PACKETS:
+        return "flows_skipped_packets"
+    return None
+
+def stream_key(row):
+    """Direction independent session key of a manifest row, flows with an unparsable name share one key"""
+    ends = sorted([(row["sip"], str(row["sport"])), (row["dip"], str(row["dport"]))])
+    return (row["proto"],) + tuple(ends)
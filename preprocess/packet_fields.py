@@ -0,0 +1,270 @@
+import itertools
+import dpkt
+from pcap_io import PcapRecordReader
+
+# fields selected by gemini 2.5 Pro
+# tshark 3.6.16
+FIELDS = [
+    # Frame-level information (useful for timing, length, and overall protocol stack)
+    "frame.time_delta", "frame.time_relative", "frame.len", "frame.protocols",
+    # IP-level information (crucial for addressing, protocol, QoS, fragmentation flags, TTL)
+    "ip.version", "ip.hdr_len", "ip.dsfield", "ip.dsfield.dscp", "ip.dsfield.ecn", "ip.len",
+    "ip.flags", "ip.flags.df", "ip.flags.mf", "ip.ttl", "ip.proto",
+    # TCP-level information (ports, segment length, header length, flags, window size, timing, analysis, payload)
+    "tcp.srcport", "tcp.dstport", "tcp.len", "tcp.hdr_len", "tcp.flags",
+    "tcp.flags.cwr", "tcp.flags.urg", "tcp.flags.ack", "tcp.flags.push",
+    "tcp.flags.reset", "tcp.flags.syn", "tcp.flags.fin", "tcp.flags.str",
+    "tcp.window_size", "tcp.time_relative", "tcp.time_delta",
+    "tcp.analysis.bytes_in_flight", "tcp.analysis.push_bytes_sent", "tcp.reassembled.length",
+    # TLS-level information (very useful for encrypted traffic identification)
+    "tls.record.content_type", "tls.record.version", "tls.record.length",
+    "tcp.payload",
+    # UDP-level information (ports, length)
+    "udp.srcport", "udp.dstport", "udp.length", "udp.time_relative", "udp.time_delta", "udp.payload"]
+
+TCP_FLAG_CHARS = [(0x100, 'N'), (0x80, 'C'), (0x40, 'E'), (0x20, 'U'), (0x10, 'A'),
+                  (0x08, 'P'), (0x04, 'R'), (0x02, 'S'), (0x01, 'F')]
+TLS_CONTENT_TYPES = {20, 21, 22, 23, 24}
+RAW_DATALINKS = {dpkt.pcap.DLT_RAW, 14, 101, 228}
+
+
+def _time(value):
+    # pcaps written by SplitCap/scapy carry microsecond timestamps
+    return "%.9f" % round(value, 6)
+
+
+def _bool(value):
+    return "1" if value else "0"
+
+
+def decode_link(buf, datalink):
+    """Return the network layer and the frame.protocols prefix of a frame"""
+    if datalink == dpkt.pcap.DLT_EN10MB:
+        eth = dpkt.ethernet.Ethernet(buf)
+        return eth.data, ["eth", "ethertype"]
+    if datalink == dpkt.pcap.DLT_LINUX_SLL:
+        sll = dpkt.sll.SLL(buf)
+        return sll.data, ["sll", "ethertype"]
+    if datalink == dpkt.pcap.DLT_NULL:
+        loop = dpkt.loopback.Loopback(buf)
+        return loop.data, ["null"]
+    if datalink in RAW_DATALINKS:
+        version = buf[0] >> 4 if buf else 0
+        if version == 4:
+            return dpkt.ip.IP(buf), ["raw"]
+        if version == 6:
+            return dpkt.ip6.IP6(buf), ["raw"]
+    return None, []
+
+
+def _tls_records(payload):
+    records = []
+    offset = 0
+    while offset + 5 <= len(payload):
+        content_type = payload[offset]
+        major, minor = payload[offset + 1], payload[offset + 2]
+        if content_type not in TLS_CONTENT_TYPES or major != 3 or minor > 4:
+            break
+        length = int.from_bytes(payload[offset + 3:offset + 5], 'big')
+        records.append((content_type, (major << 8) | minor, length))
+        offset += 5 + length
+    return records
+
+
+class _TcpStream:
+    """Per-stream state needed for the tcp.analysis.* and tcp.window_size fields"""
+
+    def __init__(self, first_ts):
+        self.first_ts = first_ts
+        self.last_ts = first_ts
+        self.wscale = {}
+        self.seen_syn = set()
+        self.base_seq = {}
+        self.next_seq = {}
+        self.last_ack = {}
+        self.push_bytes = {}
+
+    def window_size(self, direction, tcp):
+        win = tcp.win
+        if tcp.flags & dpkt.tcp.TH_SYN:
+            self.seen_syn.add(direction)
+            for opt, data in dpkt.tcp.parse_opts(tcp.opts):
+                if opt == dpkt.tcp.TCP_OPT_WSCALE and data:
+                    self.wscale[direction] = min(data[0], 14)
+            return win
+        # scaling is only known once both SYNs have been seen; tshark shows the raw value otherwise
+        if len(self.seen_syn) == 2:
+            if len(self.wscale) == 2:
+                return win << self.wscale[direction]
+        return win
+
+    def analysis(self, direction, tcp, length):
+        """Return (bytes_in_flight, push_bytes_sent) for a segment"""
+        seq = tcp.seq
+        if direction not in self.base_seq:
+            self.base_seq[direction] = seq
+        if tcp.flags & dpkt.tcp.TH_ACK:
+            self.last_ack[1 - direction] = tcp.ack
+        seg_len = length + (1 if tcp.flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN) else 0)
+        bytes_in_flight = None
+        push_bytes_sent = None
+        if seg_len:
+            end = (seq + seg_len) & 0xffffffff
+            prev_end = self.next_seq.get(direction)
+            if prev_end is None or ((end - prev_end) & 0xffffffff) < 0x80000000:
+                self.next_seq[direction] = end
+            acked = self.last_ack.get(direction, self.base_seq[direction])
+            flight = (self.next_seq[direction] - acked) & 0xffffffff
+            if flight < 0x80000000 and length:
+                bytes_in_flight = flight
+        if length:
+            self.push_bytes[direction] = self.push_bytes.get(direction, 0) + length
+            if tcp.flags & dpkt.tcp.TH_PUSH:
+                push_bytes_sent = self.push_bytes[direction]
+                self.push_bytes[direction] = 0
+        return bytes_in_flight, push_bytes_sent
+
+
+def _stream_key(ip, l4):
+    src = (bytes(ip.src), l4.sport)
+    dst = (bytes(ip.dst), l4.dport)
+    key = (ip.p,) + (src + dst if src <= dst else dst + src)
+    direction = 0 if src <= dst else 1
+    return key, direction
+
+
+class FieldExtractor:
+    """Decode the FIELDS of consecutive frames of one capture in-process.
+
+    Values follow the tshark 3.6 `-T fields` output format so that the rendered
+    flow text matches the tshark based pipeline; tcp.reassembled.length is not
+    produced since it requires full TCP reassembly.
+    """
+
+    def __init__(self, datalink=dpkt.pcap.DLT_EN10MB):
+        self.datalink = datalink
+        self.first_ts = None
+        self.prev_ts = None
+        self.tcp_streams = {}
+        self.udp_streams = {}
+
+    def extract(self, ts, buf, wirelen=None):
+        if self.first_ts is None:
+            self.first_ts = ts
+            self.prev_ts = ts
+        values = {
+            "frame.time_delta": _time(ts - self.prev_ts),
+            "frame.time_relative": _time(ts - self.first_ts),
+            "frame.len": str(wirelen or len(buf)),
+        }
+        self.prev_ts = ts
+
+        try:
+            network, protocols = decode_link(buf, self.datalink)
+        except (dpkt.UnpackError, IndexError):
+            network, protocols = None, []
+
+        if isinstance(network, dpkt.ip.IP):
+            protocols.append("ip")
+            values.update({
+                "ip.version": str(network.v),
+                "ip.hdr_len": str(network.hl * 4),
+                "ip.dsfield": "0x%02x" % network.tos,
+                "ip.dsfield.dscp": str(network.tos >> 2),
+                "ip.dsfield.ecn": str(network.tos & 0x3),
+                "ip.len": str(network.len),
+                "ip.flags": "0x%02x" % ((network.rf << 7) | (network.df << 6) | (network.mf << 5)),
+                "ip.flags.df": _bool(network.df),
+                "ip.flags.mf": _bool(network.mf),
+                "ip.ttl": str(network.ttl),
+                "ip.proto": str(network.p),
+            })
+        elif isinstance(network, dpkt.ip6.IP6):
+            protocols.append("ipv6")
+        else:
+            network = None
+
+        transport = network.data if network is not None else None
+        if isinstance(transport, dpkt.tcp.TCP):
+            protocols.append("tcp")
+            self._extract_tcp(ts, network, transport, values, protocols)
+        elif isinstance(transport, dpkt.udp.UDP):
+            protocols.append("udp")
+            self._extract_udp(ts, network, transport, values, protocols)
+
+        values["frame.protocols"] = ":".join(protocols)
+        return [(field, values[field]) for field in FIELDS if field in values]
+
+    def _extract_tcp(self, ts, ip, tcp, values, protocols):
+        payload = bytes(tcp.data)
+        # taken from the IP header so that payload-truncated packets keep their real segment length
+        if isinstance(ip, dpkt.ip.IP):
+            length = ip.len - ip.hl * 4 - tcp.off * 4
+        else:
+            length = ip.plen - tcp.off * 4
+        if length < 0:
+            length = len(payload)
+        key, direction = _stream_key(ip, tcp)
+        stream = self.tcp_streams.get(key)
+        if stream is None:
+            stream = self.tcp_streams[key] = _TcpStream(ts)
+        flags = tcp.flags & 0xfff
+        flags_str = "···" + "".join(c if flags & bit else "·" for bit, c in TCP_FLAG_CHARS)
+        values.update({
+            "tcp.srcport": str(tcp.sport),
+            "tcp.dstport": str(tcp.dport),
+            "tcp.len": str(length),
+            "tcp.hdr_len": str(tcp.off * 4),
+            "tcp.flags": "0x%04x" % flags,
+            "tcp.flags.cwr": _bool(flags & dpkt.tcp.TH_CWR),
+            "tcp.flags.urg": _bool(flags & dpkt.tcp.TH_URG),
+            "tcp.flags.ack": _bool(flags & dpkt.tcp.TH_ACK),
+            "tcp.flags.push": _bool(flags & dpkt.tcp.TH_PUSH),
+            "tcp.flags.reset": _bool(flags & dpkt.tcp.TH_RST),
+            "tcp.flags.syn": _bool(flags & dpkt.tcp.TH_SYN),
+            "tcp.flags.fin": _bool(flags & dpkt.tcp.TH_FIN),
+            "tcp.flags.str": flags_str,
+            "tcp.window_size": str(stream.window_size(direction, tcp)),
+            "tcp.time_relative": _time(ts - stream.first_ts),
+            "tcp.time_delta": _time(ts - stream.last_ts),
+        })
+        stream.last_ts = ts
+        bytes_in_flight, push_bytes_sent = stream.analysis(direction, tcp, length)
+        if bytes_in_flight is not None:
+            values["tcp.analysis.bytes_in_flight"] = str(bytes_in_flight)
+        if push_bytes_sent is not None:
+            values["tcp.analysis.push_bytes_sent"] = str(push_bytes_sent)
+        if payload:
+            records = _tls_records(payload)
+            if records:
+                protocols.append("tls")
+                values["tls.record.content_type"] = ",".join(str(r[0]) for r in records)
+                values["tls.record.version"] = ",".join("0x%04x" % r[1] for r in records)
+                values["tls.record.length"] = ",".join(str(r[2]) for r in records)
+            values["tcp.payload"] = payload.hex()
+
+    def _extract_udp(self, ts, ip, udp, values, protocols):
+        payload = bytes(udp.data)
+        key, _ = _stream_key(ip, udp)
+        first_ts, last_ts = self.udp_streams.get(key, (ts, ts))
+        self.udp_streams[key] = (first_ts, ts)
+        values.update({
+            "udp.srcport": str(udp.sport),
+            "udp.dstport": str(udp.dport),
+            "udp.length": str(udp.ulen),
+            "udp.time_relative": _time(ts - first_ts),
+            "udp.time_delta": _time(ts - last_ts),
+        })
+        if payload:
+            protocols.append("dns" if 53 in (udp.sport, udp.dport) else "data")
+            values["udp.payload"] = payload.hex()
+
+
+def iter_flow_fields(pcap_file, pnums):
+    """Yield the decoded (field, value) pairs of each flow, using pnums as flow boundaries"""
+    with open(pcap_file, 'rb') as f:
+        reader = PcapRecordReader(f)
+        extractor = FieldExtractor(reader.datalink)
+        packets = iter(reader)
+        for n in pnums:
+            yield [extractor.extract(ts, buf, wirelen) for ts, buf, wirelen in itertools.islice(packets, n)]
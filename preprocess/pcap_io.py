@@ -0,0 +1,87 @@
+import struct
+import itertools
+
+# magic number -> (byte order, timestamp divisor)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e9),
+}
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+class PcapRecordReader:
+    """Iterate (ts, captured bytes, wire length) over the records of a classic pcap file.
+
+    Unlike dpkt.pcap.Reader the original wire length is kept, so packets that were
+    truncated before being written still report their real frame length.
+    """
+
+    def __init__(self, f):
+        header = f.read(PCAP_HEADER_LEN)
+        if len(header) < PCAP_HEADER_LEN or header[:4] not in PCAP_MAGIC:
+            raise ValueError(f"{getattr(f, 'name', f)} is not a pcap file")
+        endian, self.divisor = PCAP_MAGIC[header[:4]]
+        self.datalink = struct.unpack(endian + 'I', header[20:24])[0] & 0xffff
+        self.record = struct.Struct(endian + 'IIII')
+        self.f = f
+
+    def __iter__(self):
+        while True:
+            header = self.f.read(RECORD_HEADER_LEN)
+            if len(header) < RECORD_HEADER_LEN:
+                break
+            sec, frac, caplen, wirelen = self.record.unpack(header)
+            yield sec + frac / self.divisor, self.f.read(caplen), wirelen
+
+def count_records(pcap_file, limit=None):
+    """Count the records of a pcap by walking the record headers only, stopping at limit"""
+    with open(pcap_file, 'rb') as f:
+        reader = PcapRecordReader(f)
+        count = 0
+        while limit is None or count < limit:
+            header = f.read(RECORD_HEADER_LEN)
+            if len(header) < RECORD_HEADER_LEN:
+                break
+            caplen = reader.record.unpack(header)[2]
+            f.seek(caplen, 1)
+            count += 1
+    return count
+
+def scan_pcap(pcap_file):
+    """(datalink, packet count, first ts, last ts) of a pcap, walking the record headers only"""
+    with open(pcap_file, 'rb') as f:
+        reader = PcapRecordReader(f)
+        count = 0
+        first_ts = last_ts = None
+        while True:
+            header = f.read(RECORD_HEADER_LEN)
+            if len(header) < RECORD_HEADER_LEN:
+                break
+            sec, frac, caplen, _ = reader.record.unpack(header)
+            last_ts = sec + frac / reader.divisor
+            if first_ts is None:
+                first_ts = last_ts
+            f.seek(caplen, 1)
+            count += 1
+    return reader.datalink, count, first_ts, last_ts
+
+def read_records(pcap_file, count=None):
+    """(datalink, the first count (ts, buf, wirelen) records) of a pcap"""
+    with open(pcap_file, 'rb') as f:
+        reader = PcapRecordReader(f)
+        return reader.datalink, list(itertools.islice(reader, count))
+
+def write_pcap(pcap_file, records, datalink):
+    """Write (ts, buf, wirelen) records as a microsecond pcap, keeping the wire length of truncated packets"""
+    record = struct.Struct('<IIII')
+    with open(pcap_file, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, datalink))
+        for ts, buf, wirelen in records:
+            sec = int(ts)
+            usec = int(round((ts - sec) * 1e6))
+            if usec >= 1000000:
+                sec, usec = sec + 1, usec - 1000000
+            f.write(record.pack(sec, usec, len(buf), wirelen or len(buf)))
+            f.write(buf)
@@ -1,32 +1,178 @@
 import os
-import subprocess
+import csv
+import socket
 import shutil
+import argparse
+import itertools
+import concurrent.futures
+from collections import OrderedDict, Counter
+import dpkt
+from packet_fields import decode_link
+from flow_data_preprocess import MAX_PACKET_NUM
 
-def split_pcap_file(input_dir):
-    """
-    Split a pcap file into flows using SplitCap.
-    """
-    original_dir = os.getcwd()
-    os.chdir(input_dir)
+MAX_FLOW_TABLE_SIZE = 100000  # number of concurrently open sessions per capture
+FLOW_IDLE_TIMEOUT = 120  # seconds without packets before a session is closed
+SESSION_STATS_FILE = "sessions.csv"
+CONTAINER_SUFFIX = ".flows"
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, help="directory of raw pcaps", required=True)
+    parser.add_argument("--num_workers", type=int, help="number of worker", default=os.cpu_count())
+    parser.add_argument("--max_packets", type=int, help="packets kept per session, 0 keeps all", default=MAX_PACKET_NUM)
+    parser.add_argument("--idle_timeout", type=float, help="session idle timeout in seconds", default=FLOW_IDLE_TIMEOUT)
+    parser.add_argument("--max_flows", type=int, help="flow table size", default=MAX_FLOW_TABLE_SIZE)
+    parser.add_argument("--container", action="store_true", help="write one indexed pcap per capture instead of one pcap per session")
+    args = parser.parse_args()
+    return args
 
-    output_dir = "flow"
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def session_key(buf, datalink):
+    """Return (bidirectional key, SplitCap style session name) of a TCP/UDP packet"""
+    try:
+        network, _ = decode_link(buf, datalink)
+    except (dpkt.UnpackError, IndexError):
+        return None, None
+    if isinstance(network, dpkt.ip.IP):
+        family = socket.AF_INET
+    elif isinstance(network, dpkt.ip6.IP6):
+        family = socket.AF_INET6
     else:
-        os.system(f'rmdir /S /Q {output_dir}')
-        os.makedirs(output_dir, exist_ok=True)
+        return None, None
+    transport = network.data
+    if isinstance(transport, dpkt.tcp.TCP):
+        proto = "TCP"
+    elif isinstance(transport, dpkt.udp.UDP):
+        proto = "UDP"
+    else:
+        return None, None
+
+    src = (bytes(network.src), transport.sport)
+    dst = (bytes(network.dst), transport.dport)
+    key = (proto,) + (src + dst if src <= dst else dst + src)
+    sip = socket.inet_ntop(family, src[0]).replace('.', '-').replace(':', '-')
+    dip = socket.inet_ntop(family, dst[0]).replace('.', '-').replace(':', '-')
+    name = f"{proto}_{sip}_{src[1]}_{dip}_{dst[1]}"
+    return key, name
+
+class SessionWriter:
+    """Write closed sessions either as flow/<class>/<session>.pcap files or into one indexed container"""
+
+    def __init__(self, output_dir, capture_name, datalink, container=False):
+        self.output_dir = output_dir
+        self.capture_name = capture_name
+        self.datalink = datalink
+        self.stats = []
+        self.container = None
+        if container:
+            self.container_file = open(output_dir + CONTAINER_SUFFIX + ".pcap", 'wb')
+            self.container = dpkt.pcap.Writer(self.container_file, linktype=datalink)
+        else:
+            os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, name, flow):
+        name = f"{self.capture_name}.{name}.pcap"
+        if self.container is not None:
+            offset = self.container_file.tell()
+            self.container.writepkts(flow["packets"])
+            self.stats.append([name, flow["count"], flow["bytes"], offset, len(flow["packets"])])
+        else:
+            with open(os.path.join(self.output_dir, name), 'wb') as f:
+                dpkt.pcap.Writer(f, linktype=self.datalink).writepkts(flow["packets"])
+            self.stats.append([name, flow["count"], flow["bytes"]])
+
+    def close(self):
+        if self.container is not None:
+            self.container_file.close()
+            stats_path = self.output_dir + CONTAINER_SUFFIX + ".csv"
+            header = ["name", "packets", "bytes", "offset", "count"]
+        else:
+            stats_path = os.path.join(self.output_dir, SESSION_STATS_FILE)
+            header = ["name", "packets", "bytes"]
+        with open(stats_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(self.stats)
+
+def split_capture(pcap_file, output_dir, max_packets=MAX_PACKET_NUM, idle_timeout=FLOW_IDLE_TIMEOUT,
+                  max_flows=MAX_FLOW_TABLE_SIZE, container=False):
+    """Split one raw capture into bidirectional 5-tuple sessions in a single pass.
+
+    Open sessions live in a bounded LRU flow table; a session is closed once it has
+    been idle for idle_timeout seconds or when the table is full. Only the first
+    max_packets packets of each session are kept, while the full session packet count
+    and the size of the untruncated session pcap are recorded in the stats file.
+    """
+    capture_name = os.path.basename(pcap_file)
+    flows = OrderedDict()
+    names = Counter()
+
+    with open(pcap_file, 'rb') as f:
+        reader = dpkt.pcap.UniversalReader(f)
+        datalink = reader.datalink()
+        writer = SessionWriter(output_dir, capture_name, datalink, container)
+        for ts, buf in reader:
+            while flows:
+                oldest_key, oldest = next(iter(flows.items()))
+                if ts - oldest["last_ts"] <= idle_timeout and len(flows) < max_flows:
+                    break
+                writer.write(oldest["name"], flows.pop(oldest_key))
+
+            key, name = session_key(buf, datalink)
+            if key is None:
+                continue
+            flow = flows.get(key)
+            if flow is None:
+                # a 5-tuple reused after its session was closed starts a new session file
+                names[name] += 1
+                if names[name] > 1:
+                    name = f"{name}_{names[name] - 1}"
+                flow = flows[key] = {"name": name, "packets": [], "count": 0, "bytes": 24}
+            else:
+                flows.move_to_end(key)
+            flow["last_ts"] = ts
+            flow["count"] += 1
+            flow["bytes"] += 16 + len(buf)
+            if not max_packets or len(flow["packets"]) < max_packets:
+                flow["packets"].append((ts, buf))
+
+        for flow in flows.values():
+            writer.write(flow["name"], flow)
+        writer.close()
+    return len(writer.stats)
+
+def read_container(container_path, names=None):
+    """Yield (session name, [(ts, buf), ...]) from a container written with --container"""
+    with open(container_path + ".csv", newline='') as f:
+        index = [row for row in csv.DictReader(f) if names is None or row["name"] in names]
+    with open(container_path + ".pcap", 'rb') as f:
+        reader = dpkt.pcap.Reader(f)
+        for row in index:
+            f.seek(int(row["offset"]))
+            yield row["name"], list(itertools.islice(reader, int(row["count"])))
+
+def split_pcap_file(input_dir, workers=os.cpu_count(), max_packets=MAX_PACKET_NUM, idle_timeout=FLOW_IDLE_TIMEOUT,
+                    max_flows=MAX_FLOW_TABLE_SIZE, container=False):
+    """
+    Split every pcap of input_dir into sessions under input_dir/flow/<capture name>.
+    """
+    output_dir = os.path.join(input_dir, "flow")
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
 
-    for filename in os.listdir('.'):
-        if filename.endswith('.pcap'):
+    filenames = sorted(f for f in os.listdir(input_dir) if f.endswith('.pcap') or f.endswith('.pcapng'))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for filename in filenames:
             print(f"Processing {filename}...")
-            output_dir = os.path.join("flow", os.path.splitext(filename)[0])
-            command = [
-                "SplitCap", "-r", filename, "-o", output_dir, "-s", "session"
-            ]
-            subprocess.run(command, check=True)
-    
-    os.chdir(original_dir)
+            futures[executor.submit(split_capture, os.path.join(input_dir, filename),
+                                    os.path.join(output_dir, os.path.splitext(filename)[0]),
+                                    max_packets, idle_timeout, max_flows, container)] = filename
+        for future in concurrent.futures.as_completed(futures):
+            print(f"{futures[future]}: {future.result()} sessions")
 
 if __name__ == "__main__":
-    split_pcap_file("data/test/")
-    # split_pcap_file("data/ustc-tfc/")
\ No newline at end of file
+    args = get_args()
+    split_pcap_file(args.input, args.num_workers, args.max_packets, args.idle_timeout, args.max_flows, args.container)
+    # split_pcap_file("data/test/")
+    # split_pcap_file("data/ustc-tfc/")
@@ -1,115 +1,407 @@
 import os
+import csv
+import time
 import argparse
+import collections
 import pandas as pd
 import dpkt
 import concurrent.futures
 from pathlib import Path
-from scapy.all import rdpcap, wrpcap
-from flow_data_preprocess import build_flow_data
-from preprocess_utils import build_td_text_dataset, split_dataset
+from flow_data_preprocess import build_flow_data, MAX_PACKET_NUM, MAX_PAYLOAD_LENGTH
+from packet_fields import FIELDS, decode_link
+from pcap_to_flow import SESSION_STATS_FILE
+from pcap_io import read_records, write_pcap
+from flow_manifest import scan_flows, load_flow_manifest, save_flow_manifest, skip_reason, stream_key
+from flow_features import feature_csv_path, feature_columns, load_feature_index, update_feature_index_cache, session_flow_id
+from run_manifest import RunManifest
+from flow_dedup import dedup_flows, flow_signatures, packet_text, signature_perm
+from stage_metrics import METRICS, PROFILE_ENV, profiled
+from preprocess_utils import build_td_text_dataset, split_dataset, save_render_config, DatasetWriter
 from tqdm import tqdm
 import warnings
 warnings.filterwarnings("ignore")
 
+# work of opening, filtering and rendering one flow, in bytes read, so that small flows are not free
+FLOW_COST = 4 * 1024
+TASKS_PER_WORKER = 8
+MIN_TASK_COST = 256 * 1024
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", type=str, help="raw dataset path", required=True)
     parser.add_argument("--dataset_name", type=str, help="dataset name", required=True)
     parser.add_argument("--output_path", type=str, help="output dataset path", required=True)
     parser.add_argument("--num_workers", type=int, help="number of worker", required=True)
+    parser.add_argument("--extractor", type=str, choices=["tshark", "native"], default="tshark", help="packet field extractor")
+    parser.add_argument("--output_format", type=str, choices=["csv", "parquet"], default="csv", help="dataset file format")
+    parser.add_argument("--flow_format", type=str, choices=["verbose", "compact"], default="verbose", help="flow serialization, compact uses short field codes and omits defaults")
+    parser.add_argument("--no_instruction", action="store_true", help="do not prepend the task instruction to the flows")
+    parser.add_argument("--feature_mode", type=str, choices=["text", "numeric"], default="text", help="append the CIC features to the flow text, or save them as normalized <split>.features.npy matrices")
+    parser.add_argument("--max_packets", type=int, default=MAX_PACKET_NUM, help="packets kept per flow, sessions must be split with at least as many (pcap_to_flow.py --max_packets)")
+    parser.add_argument("--window_packets", type=int, default=0, help="render flows as windows of this many packets for main.py --pooling, 0 renders one sequence")
+    parser.add_argument("--dedup", type=str, choices=["none", "exact", "near"], default="none", help="drop duplicate flows of a class before splitting, near adds MinHash LSH near duplicates")
+    parser.add_argument("--dedup_threshold", type=float, default=0.9, help="estimated Jaccard similarity of the packet shingles above which flows are near duplicates")
+    parser.add_argument("--minhash_perm", type=int, default=64, help="MinHash signature length of --dedup near")
+    parser.add_argument("--max_pending_classes", type=int, default=2, help="number of classes processed concurrently")
+    parser.add_argument("--sample_first", action="store_true", help="sample each class from pcap metadata and only extract the sampled flows")
+    parser.add_argument("--no_cache", action="store_true", help="rebuild every class instead of reusing the flows of unchanged ones")
+    parser.add_argument("--hash_inputs", action="store_true", help="fingerprint inputs by content hash as well as size and mtime")
+    parser.add_argument("--metrics_report", type=str, default=None, help="json stage timing and counter report, defaults to <output_path>/metrics.json")
+    parser.add_argument("--profile", type=str, default=None, help="write cProfile stats of the parent and every worker to <profile>.<pid>.prof")
     args = parser.parse_args()
     return args
 
-def get_session_feature(pcap, input):
+def get_session_feature(pcap, input, flow_format='verbose', allow_missing=False):
     # BitTorrent.pcap.TCP_1-1-0-12_49252_1-2-7-170_443.pcap
-    parts = pcap[0].name.split('.')
-    filename = parts[0]+'.'+parts[1]+'_Flow.csv'
-    feature_dir = os.path.join(input, 'feature', filename)
-    data = pd.read_csv(feature_dir, encoding='gbk')
-
     features = []
-    exclude_columns = {'Flow ID', 'Src IP', 'Src Port', 'Dst IP', 'Dst Port', 'Protocol', 'Timestamp', 'Flow Duration', 'Label'}
-    
+    # the indexes of this call, so its captures are loaded once whatever the bound of the load_feature_index cache
+    indexes = {}
     for p in pcap:
-        feature_str = ""
-        parts = p.name.split('.')
-        five_tuple = parts[2].split('_')
-        proto = '6' if five_tuple[0] == 'TCP' else '17'
-        sip = five_tuple[1].replace('-', '.')
-        sport = five_tuple[2]
-        dip = five_tuple[3].replace('-', '.')
-        dport = five_tuple[4]
-        flow_id = f"{sip}-{dip}-{sport}-{dport}-{proto}"
-        flow_id1 = f"{dip}-{sip}-{dport}-{sport}-{proto}"
-
-        matching_row = data[data['Flow ID'].isin([flow_id, flow_id1])]
-        
-        if not matching_row.empty:
-            row = matching_row.iloc[0]
-            feature_columns = [col for col in data.columns if col not in exclude_columns]
-            
-            feature_parts = []
-            for col in feature_columns:
-                value = row[col]
-                feature_parts.append(f"{col}: {value}")
-            
-            feature_str = ", ".join(feature_parts)
-        
-        features.append(feature_str)
-    
+        csv_path = feature_csv_path(input, p.name)
+        if not os.path.exists(csv_path):
+            if not allow_missing:
+                raise FileNotFoundError(f"CICFlowMeter feature CSV of {p.name} not found: {csv_path}")
+            # captures without a CICFlowMeter CSV, e.g. new traffic classified by predict.py
+            METRICS.count("features_no_csv")
+            features.append("")
+            continue
+        if csv_path not in indexes:
+            with METRICS.stage("feature_index"):
+                indexes[csv_path] = load_feature_index(csv_path, flow_format)
+        feature = indexes[csv_path].get(session_flow_id(p.name))
+        if feature is None:
+            METRICS.count("features_not_found")
+        features.append(feature or "")
     return features
 
-def filter_flow(pcap_path, input):
+def load_session_stats(pcap_dir):
+    """Full session packet count and size recorded by pcap_to_flow for sessions it truncated"""
+    stats_path = os.path.join(pcap_dir, SESSION_STATS_FILE)
+    if not os.path.exists(stats_path):
+        return {}
+    with open(stats_path, newline='') as f:
+        return {row['name']: (int(row['packets']), int(row['bytes'])) for row in csv.DictReader(f)}
+
+def filter_flow(pcap_path, input, session_stats=None, flow_format='verbose', manifest=None, max_packets=MAX_PACKET_NUM,
+                allow_missing_features=False):
+    """Drop small and short flows using their manifest rows, then read the first max_packets packets of the kept ones once
+
+    Returns the (ts, buf, wirelen) records, the record count of each kept flow,
+    their features and their paths. Flows missing from manifest are scanned first.
+    A capture without a feature CSV is an error unless allow_missing_features is set,
+    its flows then get no features.
+    """
     packets = []
     pnum = []
     fp = []
     features = []
-    for p in pcap_path:
-        size_kb = p.stat().st_size / 1024
-        if size_kb < 2:
+    with METRICS.stage("scan_headers"):
+        rows = scan_flows(pcap_path, manifest)
+    for p, row in zip(pcap_path, rows):
+        reason = skip_reason(row, session_stats)
+        if reason is not None:
+            METRICS.count(reason)
             continue
-        with open(str(p), 'rb') as f:
-            pcap_reader = dpkt.pcap.Reader(f)
-            packet_count = 0
-            for _, _ in pcap_reader:
-                packet_count += 1
-                if packet_count >= 3:
-                    fp.append(p)
-                    packet = rdpcap(str(p), count=5)
-                    pnum.append(len(packet))
-                    packets.extend(packet)
-                    break
+        fp.append(p)
+        with METRICS.stage("read_records"):
+            _, records = read_records(str(p), max_packets)
+        METRICS.count("bytes_read", sum(len(buf) for _, buf, _ in records))
+        pnum.append(len(records))
+        packets.extend(records)
+    METRICS.count("flows_kept", len(fp))
     if fp:
-        features = get_session_feature(fp, input)
-    return packets, pnum, features
+        features = get_session_feature(fp, input, flow_format, allow_missing_features)
+    return packets, pnum, features, fp
+
+def truncate_payload(record, datalink, max_payload=MAX_PAYLOAD_LENGTH):
+    """Keep the headers and the first max_payload payload bytes of a record, the wire length stays the original one"""
+    ts, buf, wirelen = record
+    try:
+        network, _ = decode_link(buf, datalink)
+    except (dpkt.UnpackError, IndexError):
+        return record
+    transport = getattr(network, 'data', None)
+    if not isinstance(transport, (dpkt.tcp.TCP, dpkt.udp.UDP)):
+        return record
+    payload_len = len(transport.data)
+    if payload_len <= max_payload:
+        return record
+    # frames this long carry no Ethernet padding, at most a 4 byte FCS, which only shifts the cut
+    return ts, buf[:len(buf) - payload_len + max_payload], wirelen or len(buf)
+
+def process_shard(pcap_path, input, session_stats, shard_file, extractor='tshark', flow_format='verbose', feature_mode='text',
+                  manifest=None, context=None, max_packets=MAX_PACKET_NUM, window_packets=0, allow_missing_features=False,
+                  num_perm=None):
+    """Filter a chunk of flows, write them to a worker-local pcap shard and render it
 
-def process_pcap_dir(pcap_dir: str, workers: int, outputfile, input):
+    A "{pid}" in shard_file is replaced by the worker pid, the shard is removed once rendered.
+    context lists kept flows that precede the chunk in its shard: their records
+    lead the shard so that time and stream fields render as in the whole shard,
+    and are not returned. Flows keep up to max_packets packets, rendered in
+    windows of window_packets packets when it is set. allow_missing_features is
+    passed to filter_flow.
+
+    Returns the rendered flows, their packet count, their pcap names, their
+    flow_signatures for dedup_flows when num_perm is not None (else an empty
+    list) and the stage metrics of the shard. With feature_mode='numeric' a
+    flow is a [text, numeric feature string] pair and the text has no features.
+    """
+    METRICS.reset()
+    with profiled():
+        feature_format = 'numeric' if feature_mode == 'numeric' else flow_format
+        packets, pnum, features, fp = filter_flow(pcap_path, input, session_stats, feature_format, manifest, max_packets,
+                                                     allow_missing_features)
+        if not packets:
+            return [], 0, [], [], METRICS.snapshot()
+        context_records = []
+        with METRICS.stage("read_context"):
+            for p in context or []:
+                context_records.extend(read_records(str(p), max_packets)[1])
+        # the context renders as one extra leading flow, dropped below
+        lead = 1 if context_records else 0
+        datalink = read_records(str(fp[0]), 0)[0]
+        shard_file = shard_file.replace("{pid}", str(os.getpid()))
+        with METRICS.stage("write_shard"):
+            write_pcap(shard_file, [truncate_payload(record, datalink) for record in context_records + packets], datalink)
+        shard_pnum = [len(context_records)] * lead + pnum
+        with METRICS.stage("build_flow_data." + extractor):
+            if feature_mode == 'numeric':
+                build_data = build_flow_data(shard_file, shard_pnum, [""] * len(shard_pnum), extractor, progress=False, flow_format=flow_format,
+                                             window_packets=window_packets)[lead:]
+                build_data = [[text, feature] for text, feature in zip(build_data, features)]
+            else:
+                build_data = build_flow_data(shard_file, shard_pnum, [""] * lead + features, extractor, progress=False, flow_format=flow_format,
+                                             window_packets=window_packets)[lead:]
+        os.remove(shard_file)
+        signatures = []
+        if num_perm is not None:
+            with METRICS.stage("flow_signatures"):
+                signatures = flow_signatures([packet_text(flow) for flow in build_data], num_perm)
+    return build_data, len(packets), [p.name for p in fp], signatures, METRICS.snapshot()
+
+def chunk_pcap_dir(pcap_dir: str, workers: int):
     pcap_paths = list(Path(pcap_dir).glob('*.pcap'))
-    pcap_paths = [pcap_paths[i::workers] for i in range(workers)]
-    packets = []
-    pnums = []
-    features = []
+    return [pcap_paths[i::workers] for i in range(workers)]
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-        future_to_path = {executor.submit(filter_flow, p, input): p for p in pcap_paths}
-        
-        for future in concurrent.futures.as_completed(future_to_path):
-            filered_packets, pnum, session_features = future.result()
-            packets.extend(filered_packets)
-            pnums.extend(pnum)
-            features.extend(session_features)
-    if not packets:
+def flow_cost(p, row=None, session_stats=None, max_packets=MAX_PACKET_NUM):
+    """Estimated work of one flow in bytes: a fixed per flow cost plus the records filter_flow reads"""
+    if row is None:
+        return FLOW_COST + p.stat().st_size
+    if skip_reason(row, session_stats) is not None:
+        return FLOW_COST
+    return FLOW_COST + row["size"] * min(row["packets"], max_packets) // max(row["packets"], 1)
+
+def plan_tasks(pcap_paths, costs, target):
+    """Cut pcap_paths into contiguous tasks of about target cost each, the tasks concatenate back to pcap_paths"""
+    tasks = []
+    task = []
+    cost = 0
+    for p, c in zip(pcap_paths, costs):
+        task.append(p)
+        cost += c
+        if cost >= target:
+            tasks.append(task)
+            task = []
+            cost = 0
+    if task:
+        tasks.append(task)
+    return tasks
+
+def task_target(costs, workers: int):
+    # several tasks per worker, so that workers done early pull the remaining ones
+    return max(sum(costs) / (workers * TASKS_PER_WORKER), MIN_TASK_COST)
+
+def task_context(kept, task, manifest):
+    """Flows of kept, the kept flows before task in its shard, that the rendering of task depends on.
+
+    The first one sets the time origin of the shard and the last one the time
+    delta of its first packet; flows of the same sessions as task carry the TCP
+    and UDP stream state.
+    """
+    if not kept:
         return []
-    
-    print(f"Total packets and flows after filtering: {len(packets)}, {len(pnums)}")
-    wrpcap(outputfile, packets)
-    build_data = build_flow_data(outputfile, pnums, features)
+    keys = {stream_key(manifest[p.name]) for p in task}
+    last = len(kept) - 1
+    return [p for i, p in enumerate(kept) if i == 0 or i == last or stream_key(manifest[p.name]) in keys]
+
+def submit_flow_manifest(executor, pcap_dir: str, workers: int):
+    """Submit the record header scans of the flows of a class directory to the pool, returns (saved manifest, futures)
+
+    Only flows that are new or whose file changed since the saved manifest are scanned.
+    """
+    manifest = load_flow_manifest(pcap_dir)
+    pcap_paths = [p for chunk in chunk_pcap_dir(pcap_dir, workers) for p in chunk]
+    # a known flow costs a stat, a new one a scan of its record headers
+    costs = [FLOW_COST if p.name in manifest else FLOW_COST + p.stat().st_size for p in pcap_paths]
+    futures = [executor.submit(scan_flows, task, {p.name: manifest[p.name] for p in task if p.name in manifest})
+               for task in plan_tasks(pcap_paths, costs, task_target(costs, workers))]
+    return manifest, futures
+
+def finish_flow_manifest(pcap_dir: str, manifest, futures):
+    """Collect the scans of submit_flow_manifest, save the manifest when it changed and return it"""
+    rows = [row for future in futures for row in future.result()]
+    updated = {row["name"]: row for row in rows}
+    if updated != manifest:
+        save_flow_manifest(pcap_dir, rows)
+    return updated
+
+def update_flow_manifest(executor, pcap_dir: str, workers: int):
+    """Scan the flows of a class directory in the pool and save its manifest, see submit_flow_manifest"""
+    return finish_flow_manifest(pcap_dir, *submit_flow_manifest(executor, pcap_dir, workers))
+
+def sample_pcap_dir(executor, pcap_dir: str, workers: int, manifest=None):
+    """Filter a class directory from its flow manifest and draw its train/val/test sample before any packet is read.
+
+    The candidates are kept in the order process_pcap_dir would build them, so
+    split_dataset picks the same flows as when it runs on the built data.
+    """
+    if manifest is None:
+        manifest = update_flow_manifest(executor, pcap_dir, workers)
+    session_stats = load_session_stats(pcap_dir)
+    candidates = [p for chunk in chunk_pcap_dir(pcap_dir, workers) for p in chunk
+                  if skip_reason(manifest[p.name], session_stats) is None]
+    return split_dataset(candidates)
+
+def submit_pcap_dir(executor, pcap_dir: str, workers: int, outputfile, input, extractor='tshark', pcap_paths=None,
+                    flow_format='verbose', feature_mode='text', manifest=None, max_packets=MAX_PACKET_NUM, window_packets=0,
+                    num_perm=None):
+    """Submit the tasks of one class directory to executor, returns their futures in task order
+
+    pcap_paths restricts the work to the given flows of the directory. The flows
+    are split in one shard per worker as before, and with a manifest every shard
+    is cut into tasks sized from its rows that idle workers pull from the pool
+    queue; each task renders as within its whole shard, so the output does not
+    depend on the cut. Without one every shard is a single task.
+    """
+    if pcap_paths is None:
+        pcap_paths = chunk_pcap_dir(pcap_dir, workers)
+    else:
+        pcap_paths = [pcap_paths[i::workers] for i in range(workers)]
+    session_stats = load_session_stats(pcap_dir)
+    manifest = manifest or {}
+    # write the Parquet cache of every feature index before the tasks that read it, so workers do not all build it
+    # from the CSV; the parent keeps no index, each worker loads the ones of its tasks (the pool is already started)
+    for csv_path in sorted({feature_csv_path(input, p.name) for chunk in pcap_paths for p in chunk}):
+        if os.path.exists(csv_path):
+            update_feature_index_cache(csv_path, 'numeric' if feature_mode == 'numeric' else flow_format)
+    shard_file = os.path.splitext(outputfile)[0] + "_{pid}.pcap"
+
+    costs = {p.name: flow_cost(p, manifest.get(p.name), session_stats, max_packets) for chunk in pcap_paths for p in chunk}
+    target = task_target(list(costs.values()), workers)
+    futures = []
+    for chunk in pcap_paths:
+        if not chunk:
+            continue
+        tasks = [chunk]
+        if all(p.name in manifest for p in chunk):
+            tasks = plan_tasks(chunk, [costs[p.name] for p in chunk], target)
+        kept = []
+        for task in tasks:
+            task_stats = {q.name: session_stats[q.name] for q in task if q.name in session_stats}
+            task_manifest = {q.name: manifest[q.name] for q in task if q.name in manifest}
+            futures.append(executor.submit(process_shard, task, input, task_stats, shard_file, extractor, flow_format,
+                                           feature_mode, task_manifest, task_context(kept, task, manifest), max_packets,
+                                           window_packets, False, num_perm))
+            kept.extend(p for p in task if p.name in manifest and skip_reason(manifest[p.name], session_stats) is None)
+    METRICS.count("tasks", len(futures))
+    return futures
+
+def collect_pcap_dir(futures):
+    """Return the built flows of the shards, the pcap names they come from and their signatures, see process_shard"""
+    build_data = []
+    names = []
+    signatures = []
+    packet_count = 0
+    # collect in task order so flows stay aligned with their features and runs are reproducible
+    for future in tqdm(futures):
+        with METRICS.stage("wait_workers"):
+            shard_data, shard_packets, shard_names, shard_signatures, shard_metrics = future.result()
+        METRICS.merge(shard_metrics)
+        build_data.extend(shard_data)
+        names.extend(shard_names)
+        signatures.extend(shard_signatures)
+        packet_count += shard_packets
+    if not build_data:
+        return [], [], []
+
+    print(f"Total packets and flows after filtering: {packet_count}, {len(build_data)}")
     print(f"Total flows after building: {len(build_data)}")
     
-    return build_data
+    return build_data, names, signatures
+
+def process_pcap_dir(pcap_dir: str, workers: int, outputfile, input, extractor='tshark', flow_format='verbose'):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        manifest = update_flow_manifest(executor, pcap_dir, workers)
+        return collect_pcap_dir(submit_pcap_dir(executor, pcap_dir, workers, outputfile, input, extractor, flow_format=flow_format,
+                                                manifest=manifest))[0]
+
+def class_text_dataset(flows, int_label, str_label, task_name, with_instruction=True):
+    """build_td_text_dataset of one class, [text, numeric feature] flows get a "features" column"""
+    numeric = bool(flows) and isinstance(flows[0], list)
+    texts = [flow[0] for flow in flows] if numeric else flows
+    with METRICS.stage("build_td_text_dataset"):
+        text_data = build_td_text_dataset(texts, int_label=int_label, str_label=str_label, task_name=task_name, granularity='session', with_instruction=with_instruction)
+    if numeric:
+        text_data["features"] = [flow[1] for flow in flows]
+    return text_data
+
+def dedup_class(build_data, signatures, mode, threshold=0.9, num_perm=64):
+    """dedup_flows of the flows of a class, in split order when build_data holds sampled splits
+
+    signatures is shaped like build_data, or None for a cached class.
+    """
+    if not isinstance(build_data, dict):
+        (flows,), dedup = dedup_flows([build_data], signatures and [signatures], mode, threshold, num_perm)
+        return flows, dedup
+    splits, dedup = dedup_flows([build_data[split] for split in ["train", "val", "test"]],
+                                signatures and [signatures[split] for split in ["train", "val", "test"]], mode, threshold, num_perm)
+    # "data" holds every sampled flow, keep the ones a split kept
+    kept = collections.Counter(flow[0] if isinstance(flow, list) else flow for flows in splits for flow in flows)
+    data = []
+    for flow in build_data["data"]:
+        text = flow[0] if isinstance(flow, list) else flow
+        if kept[text]:
+            kept[text] -= 1
+            data.append(flow)
+    return dict(zip(["data", "train", "val", "test"], [data] + splits)), dedup
+
+def write_class_dataset(writer, build_data, int_label, str_label, task_name, with_instruction=True):
+    """Render one class once, split it and append every split to the dataset writer
+
+    build_data is either the list of all flows of the class, or a dict with the
+    already sampled "data", "train", "val" and "test" flows.
+    """
+    if isinstance(build_data, dict):
+        for split in ["data", "train", "val", "test"]:
+            text_data = class_text_dataset(build_data[split], int_label, str_label, task_name, with_instruction)
+            with METRICS.stage("write_dataset"):
+                writer.write(split, text_data)
+        return
+    text_data = class_text_dataset(build_data, int_label, str_label, task_name, with_instruction)
+    # split_dataset draws the same rows from the rendered frame as from the flow list (random_state=42 per class)
+    with METRICS.stage("split_dataset"):
+        train_data, val_data, test_data = split_dataset(text_data)
+    with METRICS.stage("write_dataset"):
+        writer.write("data", text_data)
+        writer.write("train", train_data)
+        writer.write("val", val_data)
+        writer.write("test", test_data)
 
 def main():
     args = get_args()
+    start = time.perf_counter()
+    if args.profile:
+        # inherited by the pool workers, see stage_metrics.profiled
+        os.environ[PROFILE_ENV] = os.path.abspath(args.profile)
+    with profiled():
+        run(args)
+    report_path = args.metrics_report or os.path.join(args.output_path, "metrics.json")
+    report = METRICS.write_report(report_path, time.perf_counter() - start, workers=args.num_workers, extractor=args.extractor)
+    print(f"Metrics report is saved in: {report_path}")
+    for name, stage in list(report["stages"].items())[:5]:
+        print(f"  {name}: {stage['seconds']:.2f}s in {stage['calls']} calls")
+
+def run(args):
 
     if args.dataset_name == "ustc-tfc-2016":
         detection_task="EMD"
@@ -132,50 +424,112 @@ def main():
     else:
         detection_task="EAC"
 
+    # worker-local pcap shards of the filtered flows are written to filtered/<class>_<pid>.pcap
     if not os.path.exists(os.path.join(args.input, 'filtered')):
         os.makedirs(os.path.join(args.input, 'filtered'))
     if not os.path.exists(args.output_path):
         os.makedirs(args.output_path)
 
-    subdirs = [d for d in Path(os.path.join(args.input, 'flow')).iterdir() if d.is_dir()]
-    dataset = []
-    train_dataset = []
-    val_dataset = []
-    test_dataset = []
+    # sorted so that label ids do not depend on the directory listing order
+    subdirs = sorted(d for d in Path(os.path.join(args.input, 'flow')).iterdir() if d.is_dir())
     label = {'str': [], 'int': []}
     
-    for subdir in subdirs:
-        print(f"Processing directory: {subdir.name}")
-        filtered_pcap_path = os.path.join(args.input, 'filtered', subdir.name + '.pcap')
-        build_data = process_pcap_dir(str(subdir), args.num_workers, filtered_pcap_path, args.input) 
+    # the shard layout follows num_workers and the time fields are relative to the first packet of a shard,
+    # so a class rendered with other workers renders differently
+    params = {"num_workers": args.num_workers, "max_packet_num": args.max_packets, "window_packets": args.window_packets, "max_payload_length": MAX_PAYLOAD_LENGTH,
+              "fields": FIELDS, "extractor": args.extractor, "sample_first": args.sample_first,
+              "flow_format": args.flow_format, "feature_mode": args.feature_mode}
+    manifest = RunManifest(os.path.join(args.input, 'filtered'), params)
+    
+    # parquet keeps the instruction once in the file metadata instead of in every row
+    with_instruction = args.output_format != "parquet" and not args.no_instruction
+    instruction = "" if args.no_instruction else build_td_text_dataset([], task_name=detection_task, granularity='session').attrs["instruction"]
+    columns = None
+    if args.feature_mode == "numeric":
+        feature_csvs = sorted(Path(args.input, 'feature').glob('*_Flow.csv'))
+        if not feature_csvs:
+            raise ValueError(f"--feature_mode numeric needs the CICFlowMeter CSVs in {os.path.join(args.input, 'feature')}")
+        columns = feature_columns(str(feature_csvs[0]))
+    writer = DatasetWriter(args.output_path, args.output_format, instruction, columns)
+
+    def finish_class(subdir, inputs, build_data, futures, splits):
+        # the workers sign the flows they render when deduplicating, cached flows are signed by dedup_flows
+        signatures = None
+        if futures is None:
+            flow_count = len(build_data["data"]) if isinstance(build_data, dict) else len(build_data)
+            print(f"Inputs of {subdir.name} unchanged, using {flow_count} cached flows")
+        else:
+            print(f"Finishing directory: {subdir.name}")
+            build_data, names, signatures = collect_pcap_dir(futures)
+            if splits is not None and build_data:
+                flows = dict(zip(names, build_data))
+                build_data = {"data": build_data}
+                for split, paths in zip(["train", "val", "test"], splits):
+                    build_data[split] = [flows[p.name] for p in paths if p.name in flows]
+                if signatures:
+                    signed = dict(zip(names, signatures))
+                    signatures = {split: [signed[p.name] for p in paths if p.name in signed]
+                                  for split, paths in zip(["train", "val", "test"], splits)}
+            manifest.store_flows(subdir.name, inputs, build_data)
         if not build_data:
             print(f"Total packets and flows after filtering: 0, 0")
-            continue
+            return
+        if args.dedup != "none":
+            # the cached flows are the ones before dedup, so changing the dedup options needs no rebuild
+            build_data, dedup = dedup_class(build_data, signatures or None, args.dedup, args.dedup_threshold, args.minhash_perm)
+            print(f"Duplicates of {subdir.name} removed: {dedup.removed['exact']} exact, {dedup.removed['near']} near, "
+                  f"{dedup.removed_chars} chars")
         label["int"].append(len(label["str"]))
         label["str"].append(subdir.name)
-        train_data, val_data, test_data = split_dataset(build_data)
+        write_class_dataset(writer, build_data, label["int"][-1], label["str"][-1], detection_task, with_instruction)
 
-        build_text_data = build_td_text_dataset(build_data,int_label=label["int"][-1], str_label=label["str"][-1], task_name=detection_task, granularity='session')
-        train_text_data = build_td_text_dataset(train_data, int_label=label["int"][-1], str_label=label["str"][-1], task_name=detection_task, granularity='session')
-        val_text_data = build_td_text_dataset(val_data, int_label=label["int"][-1], str_label=label["str"][-1], task_name=detection_task, granularity='session')
-        test_text_data = build_td_text_dataset(test_data, int_label=label["int"][-1], str_label=label["str"][-1], task_name=detection_task, granularity='session')
-    
-        dataset.append(build_text_data)
-        train_dataset.append(train_text_data)
-        val_dataset.append(val_text_data)
-        test_dataset.append(test_text_data)
-
-    dataset = pd.concat(dataset, ignore_index=True)
-    train_dataset = pd.concat(train_dataset, ignore_index=True)
-    val_dataset = pd.concat(val_dataset, ignore_index=True)
-    test_dataset = pd.concat(test_dataset, ignore_index=True)
-    label = pd.DataFrame(label)
+    # one pool for the whole run; the shards of up to max_pending_classes classes are in flight while
+    # classes are finished and written in order, so only those classes are held in memory
+    pending = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        # the header scans of every class to rebuild are queued ahead of all shard tasks, the pool runs tasks
+        # in submission order, so waiting for the manifest of a class never waits for the shards of earlier ones
+        classes = []
+        for subdir in subdirs:
+            pcap_paths = list(subdir.glob('*.pcap'))
+            inputs = manifest.class_inputs(pcap_paths, {feature_csv_path(args.input, p.name) for p in pcap_paths}, args.hash_inputs)
+            scan = None
+            if args.no_cache or not manifest.is_cached(subdir.name, inputs):
+                scan = submit_flow_manifest(executor, str(subdir), args.num_workers)
+            classes.append((subdir, pcap_paths, inputs, scan))
+        for subdir, pcap_paths, inputs, scan in classes:
+            print(f"Processing directory: {subdir.name}")
+            build_data = None if scan is not None else manifest.load_flows(subdir.name, inputs)
+            futures = None
+            splits = None
+            if build_data is not None:
+                METRICS.count("classes_cached")
+            else:
+                print(f"Changed pcaps: {len(manifest.changed_pcaps(subdir.name, inputs))}/{len(pcap_paths)}")
+                filtered_pcap_path = os.path.join(args.input, 'filtered', subdir.name + '.pcap')
+                sampled_paths = None
+                with METRICS.stage("flow_manifest"):
+                    # a cache file removed since the check above is scanned now
+                    flow_manifest = finish_flow_manifest(str(subdir), *(scan or submit_flow_manifest(executor, str(subdir), args.num_workers)))
+                if args.sample_first:
+                    with METRICS.stage("sample_first"):
+                        splits = sample_pcap_dir(executor, str(subdir), args.num_workers, flow_manifest)
+                    sampled_paths = list({p.name: p for split in splits for p in split}.values())
+                    print(f"Sampled flows: {len(sampled_paths)}")
+                futures = submit_pcap_dir(executor, str(subdir), args.num_workers, filtered_pcap_path, args.input, args.extractor, sampled_paths,
+                                          args.flow_format, args.feature_mode, flow_manifest, args.max_packets, args.window_packets,
+                                          signature_perm(args.dedup, args.minhash_perm))
+            pending.append((subdir, inputs, build_data, futures, splits))
+            while len(pending) > args.max_pending_classes:
+                finish_class(*pending.popleft())
+        while pending:
+            finish_class(*pending.popleft())
 
-    dataset.to_csv(os.path.join(args.output_path, "data.tsv"), index=False)
-    train_dataset.to_csv(os.path.join(args.output_path, "train.tsv"), index=False)
-    val_dataset.to_csv(os.path.join(args.output_path, "val.tsv"), index=False)
-    test_dataset.to_csv(os.path.join(args.output_path, "test.tsv"), index=False)
+    writer.close()
+    label = pd.DataFrame(label)
     label.to_csv(os.path.join(args.output_path, "label.tsv"), index=False)
+    # main.py saves these with the model, so predict.py renders new traffic the same way
+    save_render_config(args.output_path, args.max_packets, args.window_packets, args.flow_format)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
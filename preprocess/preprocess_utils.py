@@ -1,10 +1,18 @@
 import os
+import json
 from sklearn.model_selection import train_test_split
 from sklearn.utils import resample
+import numpy as np
 import pandas as pd
 
 
 MAX_SAMPLING_NUMBER = 600  # 5000 # number of samples per class
+INSTRUCTION_METADATA_KEY = b"instruction"
+PARQUET_ROW_GROUP_SIZE = 10000  # rows per Parquet row group
+FEATURE_STATS_FILE = "feature_stats.json"
+FEATURE_MATRIX_SUFFIX = ".features.npy"
+RENDER_CONFIG_FILE = "render_config.json"  # packets per flow and per window and the flow format a dataset was rendered with
+WINDOW_SEP = " <window> "  # separates the packet windows of a flow rendered with --window_packets
 
 def split_dataset(build_data):
     if len(build_data) < 10:
@@ -16,34 +24,153 @@ def split_dataset(build_data):
 
     return train_data, val_data, test_data
 
-def split_dataset_with_tsv(data_dir):
-    data = pd.read_csv(os.path.join(data_dir, 'data.tsv'))
-    grouped_data = data.groupby('labels')
-    train_data = pd.DataFrame()
-    val_data = pd.DataFrame()
-    test_data = pd.DataFrame()
-    for label, group in grouped_data:
+def split_dataset_with_tsv(data_dir, chunksize=100000):
+    """Split data_dir/data.tsv into train/val/test.tsv in a single streaming pass.
+
+    Each label keeps a reservoir of at most MAX_SAMPLING_NUMBER rows drawn with its own
+    RandomState(42), so memory is bounded by the number of labels rather than the file size.
+    Labels with no more rows than the cap keep all of them in file order and are split exactly
+    as split_dataset does; larger labels get a uniform seeded sample instead of resample().
+    """
+    reservoirs = {}
+    seen = {}
+    rngs = {}
+    columns = None
+    for chunk in pd.read_csv(os.path.join(data_dir, 'data.tsv'), chunksize=chunksize):
+        columns = list(chunk.columns)
+        for label, group in chunk.groupby('labels', sort=False):
+            rows = list(group.itertuples(index=False, name=None))
+            reservoir = reservoirs.setdefault(label, [])
+            start = seen.get(label, 0)
+            seen[label] = start + len(rows)
+            free = max(0, MAX_SAMPLING_NUMBER - len(reservoir))
+            reservoir.extend(rows[:free])
+            rows = rows[free:]
+            if not rows:
+                continue
+            rng = rngs.setdefault(label, np.random.RandomState(42))
+            # algorithm R: the i-th row of a label replaces a random slot with probability cap / (i + 1)
+            slots = rng.randint(0, np.arange(start + free, start + free + len(rows)) + 1)
+            for row, slot in zip(rows, slots):
+                if slot < MAX_SAMPLING_NUMBER:
+                    reservoir[slot] = row
+
+    writer = DatasetWriter(data_dir)
+    for label in sorted(reservoirs):
+        group = pd.DataFrame(reservoirs[label], columns=columns)
         if len(group) < 10:
             train = val = test = group
-        elif len(group) > MAX_SAMPLING_NUMBER:
-            sampled_group = resample(group, n_samples=MAX_SAMPLING_NUMBER, random_state=42, replace=False)
-            train, temp = train_test_split(sampled_group, test_size=0.2, random_state=42, shuffle=True)
-            val, test = train_test_split(temp, test_size=0.5, random_state=42, shuffle=True)
         else:
-            sampled_group = group
-            train, temp = train_test_split(sampled_group, test_size=0.2, random_state=42, shuffle=True)
+            train, temp = train_test_split(group, test_size=0.2, random_state=42, shuffle=True)
             val, test = train_test_split(temp, test_size=0.5, random_state=42, shuffle=True)
+        writer.write('train', train)
+        writer.write('val', val)
+        writer.write('test', test)
+        print(f"label {label}: {seen[label]} rows, {len(train)}/{len(val)}/{len(test)} train/val/test")
+    writer.close()
+
+def save_render_config(output_path, max_packets, window_packets, flow_format='verbose'):
+    with open(os.path.join(output_path, RENDER_CONFIG_FILE), "w") as f:
+        json.dump({"max_packets": max_packets, "window_packets": window_packets, "flow_format": flow_format}, f)
+
+def load_render_config(data_dir):
+    """The save_render_config of a dataset or a saved model, empty for ones written before it existed"""
+    path = os.path.join(data_dir, RENDER_CONFIG_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def signed_log1p(x):
+    return np.sign(x) * np.log1p(np.abs(x))
+
+def feature_stats(matrix, columns):
+    """Per-column mean and std of the signed log1p of a raw feature matrix, nan values ignored"""
+    transformed = signed_log1p(matrix.astype(np.float64))
+    mean = np.nan_to_num(np.nanmean(transformed, axis=0)) if len(matrix) else np.zeros(len(columns))
+    std = np.nan_to_num(np.nanstd(transformed, axis=0)) if len(matrix) else np.ones(len(columns))
+    std[std == 0] = 1.0
+    return {"columns": list(columns), "transform": "signed_log1p", "mean": mean.tolist(), "std": std.tolist()}
+
+def normalize_features(matrix, stats):
+    """float32 z-scores of signed log1p(matrix) under stats, missing values become the mean (0)"""
+    normalized = (signed_log1p(matrix.astype(np.float64)) - np.array(stats["mean"])) / np.array(stats["std"])
+    return np.nan_to_num(normalized, nan=0.0, posinf=0.0, neginf=0.0).astype(np.float32)
+
+class DatasetWriter:
+    """Write dataset splits as <split>.tsv (CSV) or as <split>.parquet.
+
+    The Parquet files are zstd compressed, every write() becomes one row group and the
+    instruction prefix shared by all rows is stored once in the file metadata.
+
+    With feature_columns, the raw vectors of a "features" column are written aside
+    instead, and close() saves them as normalized <split>.features.npy float32
+    matrices, row-aligned with the split files, using statistics of the train split
+    that are kept in feature_stats.json.
+    """
+
+    def __init__(self, output_path, output_format="csv", instruction="", feature_columns=None):
+        self.output_path = output_path
+        self.output_format = output_format
+        self.instruction = instruction
+        self.feature_columns = feature_columns
+        self.writers = {}
+        self.feature_files = {}
+
+    def write_features(self, split, features):
+        # imported here so preprocess.preprocess_utils stays importable as a package module, see split_dataset.py
+        from flow_features import parse_feature_vector
+        if split not in self.feature_files:
+            self.feature_files[split] = open(os.path.join(self.output_path, split + ".features.raw"), "wb")
+        matrix = np.array([parse_feature_vector(f, len(self.feature_columns)) for f in features], dtype=np.float32)
+        matrix.tofile(self.feature_files[split])
+
+    def write(self, split, data):
+        if self.feature_columns is not None and "features" in data:
+            self.write_features(split, data["features"])
+            data = data.drop(columns=["features"])
+        if self.output_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            table = table.replace_schema_metadata({INSTRUCTION_METADATA_KEY: self.instruction.encode("utf-8")})
+            if split not in self.writers:
+                path = os.path.join(self.output_path, split + ".parquet")
+                self.writers[split] = pq.ParquetWriter(path, table.schema, compression="zstd")
+            self.writers[split].write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+        else:
+            path = os.path.join(self.output_path, split + ".tsv")
+            data.to_csv(path, index=False, mode="a" if split in self.writers else "w", header=split not in self.writers)
+            self.writers[split] = path
+
+    def close(self):
+        if self.output_format == "parquet":
+            for writer in self.writers.values():
+                writer.close()
+        self.writers = {}
+        if self.feature_files:
+            self.close_features()
+
+    def close_features(self):
+        width = len(self.feature_columns)
+        matrices = {}
+        for split, f in self.feature_files.items():
+            f.close()
+            matrices[split] = np.fromfile(f.name, dtype=np.float32).reshape(-1, width)
+            os.remove(f.name)
+        self.feature_files = {}
+        stats = feature_stats(matrices.get("train", np.zeros((0, width), dtype=np.float32)), self.feature_columns)
+        with open(os.path.join(self.output_path, FEATURE_STATS_FILE), "w") as f:
+            json.dump(stats, f)
+        for split, matrix in matrices.items():
+            np.save(os.path.join(self.output_path, split + FEATURE_MATRIX_SUFFIX), normalize_features(matrix, stats))
 
-        train_data = pd.concat([train_data, train], ignore_index=True)
-        val_data = pd.concat([val_data, val], ignore_index=True)
-        test_data = pd.concat([test_data, test], ignore_index=True)
-    
-    train_data.to_csv(os.path.join(data_dir, 'train.tsv'), index=False)
-    val_data.to_csv(os.path.join(data_dir, 'val.tsv'), index=False)
-    test_data.to_csv(os.path.join(data_dir, 'test.tsv'), index=False)
+def build_td_text_dataset(traffic_data, int_label=0, str_label='', task_name=None, granularity='', with_instruction=True):
+    """Building the text datasets of traffic detection task
 
-def build_td_text_dataset(traffic_data, int_label=0, str_label='', task_name=None, granularity=''):
-    """Building the text datasets of traffic detection task"""
+    The instruction prefix is kept in dataset.attrs["instruction"]; with_instruction=False
+    leaves it out of the inputs so it can be stored once per dataset instead of per row.
+    """
     if task_name == "EMD":
         instruction = "Given the following traffic data <" + granularity + "> that contains protocol fields, " \
                       "traffic features, and payloads of the first five packets in a session and the session statistical features. "\
@@ -142,13 +269,15 @@ def build_td_text_dataset(traffic_data, int_label=0, str_label='', task_name=Non
     #
     #     output = "The traffic category is likely to be recognized as " + label + "."
 
+    prefix = str(instruction) + "\\n<" + granularity + ">: "
     dataset = {"inputs": [], "labels": [], "str_labels": []}
     for data in traffic_data:
         dataset["inputs"].append(
-            str(instruction) + "\\n<" + granularity + ">: " + data
+            prefix + data if with_instruction else data
         )
         dataset["labels"].append(int_output)
         dataset["str_labels"].append(str_output)
     dataset = pd.DataFrame(dataset)
+    dataset.attrs["instruction"] = prefix
 
     return dataset
\ No newline at end of file
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILE = "manifest.json"
+
+def file_fingerprint(path, with_hash=False):
+    """(size, mtime, sha1) of a file, the content hash is only computed when asked for"""
+    stat = os.stat(path)
+    digest = None
+    if with_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+    return [stat.st_size, stat.st_mtime_ns, digest]
+
+def _write_json(path, data):
+    # write then rename, so an interrupted run never leaves a truncated file behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class RunManifest:
+    """Per-class record of the input fingerprints and parameters a run used, and the flows it built.
+
+    A class is rebuilt only when one of its pcaps, one of its feature CSVs or a
+    parameter changed; the flows of the other classes are read back from the cache.
+    The manifest is saved after every class so an interrupted run resumes where it stopped.
+    """
+
+    def __init__(self, cache_dir, params):
+        self.cache_dir = cache_dir
+        self.params = params
+        self.path = os.path.join(cache_dir, MANIFEST_FILE)
+        self.classes = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.classes = json.load(f).get("classes", {})
+
+    def class_inputs(self, pcap_paths, feature_paths, with_hash=False):
+        return {
+            "params": self.params,
+            "pcaps": {p.name: file_fingerprint(str(p), with_hash) for p in sorted(pcap_paths)},
+            "features": {os.path.basename(p): file_fingerprint(p, with_hash) for p in sorted(feature_paths) if os.path.exists(p)},
+        }
+
+    def _flows_path(self, class_name):
+        return os.path.join(self.cache_dir, class_name + ".flows.json")
+
+    def is_cached(self, class_name, inputs):
+        entry = self.classes.get(class_name)
+        return entry is not None and entry["inputs"] == inputs and os.path.exists(self._flows_path(class_name))
+
+    def load_flows(self, class_name, inputs):
+        """Return the cached flows of class_name, or None when its inputs changed"""
+        if not self.is_cached(class_name, inputs):
+            return None
+        with open(self._flows_path(class_name), encoding='utf-8') as f:
+            return json.load(f)
+
+    def changed_pcaps(self, class_name, inputs):
+        entry = self.classes.get(class_name)
+        if entry is None:
+            return list(inputs["pcaps"])
+        old = entry["inputs"]["pcaps"]
+        return [name for name, fp in inputs["pcaps"].items() if old.get(name) != fp]
+
+    def store_flows(self, class_name, inputs, flows):
+        _write_json(self._flows_path(class_name), flows)
+        self.classes[class_name] = {"inputs": inputs, "flows": len(flows)}
+        _write_json(self.path, {"params": self.params, "classes": self.classes})
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import cProfile
+import contextlib
+from collections import Counter, defaultdict
+
+class StageMetrics:
+    """Wall time and call count per stage plus named counters, kept per process.
+
+    Workers return snapshot() with their results and the parent merge()s it,
+    so the report covers the time spent in every process of the pool.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def add_time(self, name, seconds):
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def snapshot(self):
+        return {"seconds": dict(self.seconds), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def merge(self, snapshot):
+        for name, seconds in snapshot["seconds"].items():
+            self.seconds[name] += seconds
+        self.calls.update(snapshot["calls"])
+        self.counters.update(snapshot["counters"])
+
+    def report(self, wall_seconds=None, **extra):
+        stages = {name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                  for name in sorted(self.seconds, key=self.seconds.get, reverse=True)}
+        report = {"wall_seconds": wall_seconds, "stages": stages, "counters": dict(sorted(self.counters.items()))}
+        report.update(extra)
+        return report
+
+    def write_report(self, path, wall_seconds=None, **extra):
+        report = self.report(wall_seconds, **extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+METRICS = StageMetrics()
+
+PROFILE_ENV = "FLOW_PROFILE"
+_profiler = None
+_profiler_pid = None
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """Accumulate a cProfile of the enclosed code into path.<pid>.prof, for pstats or snakeviz.
+
+    path defaults to the FLOW_PROFILE environment variable, which workers inherit
+    from the parent; nothing is profiled when neither is set. Sampling profilers
+    such as py-spy need no hook: `py-spy record --subprocesses -- python preprocess.py ...`.
+    """
+    global _profiler, _profiler_pid
+    path = path or os.environ.get(PROFILE_ENV)
+    if not path:
+        yield
+        return
+    # a forked worker starts its own profile instead of adding to the copy of the parent's
+    if _profiler is None or _profiler_pid != os.getpid():
+        _profiler = cProfile.Profile()
+        _profiler_pid = os.getpid()
+    _profiler.enable()
+    try:
+        yield
+    finally:
+        _profiler.disable()
+        _profiler.dump_stats(f"{path}.{os.getpid()}.prof")
@@ -0,0 +1,123 @@
+import os
+import csv
+import socket
+import struct
+import argparse
+import numpy as np
+import dpkt
+
+# a subset of the CICFlowMeter columns, enough to exercise the feature index at a realistic width
+CIC_FEATURE_COLUMNS = [
+    "Total Fwd Packet", "Total Bwd packets", "Total Length of Fwd Packet", "Total Length of Bwd Packet",
+    "Fwd Packet Length Max", "Fwd Packet Length Min", "Fwd Packet Length Mean", "Fwd Packet Length Std",
+    "Bwd Packet Length Max", "Bwd Packet Length Min", "Bwd Packet Length Mean", "Bwd Packet Length Std",
+    "Flow Bytes/s", "Flow Packets/s", "Flow IAT Mean", "Flow IAT Std", "Flow IAT Max", "Flow IAT Min",
+    "Fwd IAT Total", "Fwd IAT Mean", "Fwd IAT Std", "Fwd IAT Max", "Fwd IAT Min",
+    "Bwd IAT Total", "Bwd IAT Mean", "Bwd IAT Std", "Bwd IAT Max", "Bwd IAT Min",
+    "Fwd PSH Flags", "Bwd PSH Flags", "Fwd Header Length", "Bwd Header Length",
+    "Fwd Packets/s", "Bwd Packets/s", "Packet Length Min", "Packet Length Max", "Packet Length Mean",
+    "Packet Length Std", "Packet Length Variance", "FIN Flag Count", "SYN Flag Count", "RST Flag Count",
+    "PSH Flag Count", "ACK Flag Count", "Down/Up Ratio", "Average Packet Size", "FWD Init Win Bytes",
+    "Bwd Init Win Bytes", "Idle Mean", "Idle Std", "Idle Max", "Idle Min",
+]
+
+def get_args():
+    parser = argparse.ArgumentParser(description="generate synthetic raw captures and CICFlowMeter-style feature CSVs")
+    parser.add_argument("--output", type=str, help="raw dataset path to create", required=True)
+    parser.add_argument("--classes", type=int, help="number of classes, one capture each", default=4)
+    parser.add_argument("--flows", type=int, help="flows per class", default=500)
+    parser.add_argument("--packets", type=int, help="mean packets per flow", default=10)
+    parser.add_argument("--min_payload", type=int, help="min TCP payload bytes", default=0)
+    parser.add_argument("--max_payload", type=int, help="max TCP payload bytes", default=1400)
+    parser.add_argument("--udp_ratio", type=float, help="fraction of UDP flows", default=0.1)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+    return args
+
+def tls_payload(rng, size):
+    # application data records, so that the TLS fields are decoded as well
+    body = rng.bytes(max(size - 5, 0))
+    return b'\x17\x03\x03' + struct.pack('>H', len(body)) + body
+
+def flow_packets(rng, sip, dip, sport, dport, udp, packets, min_payload, max_payload, start_ts):
+    """(ts, frame) of one bidirectional flow, alternating direction with random payload sizes"""
+    frames = []
+    ts = start_ts
+    seq = {True: int(rng.randint(1, 1 << 31)), False: int(rng.randint(1, 1 << 31))}
+    for i in range(packets):
+        forward = i % 2 == 0
+        src, dst, sp, dp = (sip, dip, sport, dport) if forward else (dip, sip, dport, sport)
+        size = int(rng.randint(min_payload, max_payload + 1))
+        if udp:
+            l4 = dpkt.udp.UDP(sport=sp, dport=dp, data=rng.bytes(size))
+            l4.ulen = 8 + size
+            proto = dpkt.ip.IP_PROTO_UDP
+        else:
+            payload = tls_payload(rng, size) if size >= 5 else rng.bytes(size)
+            flags = dpkt.tcp.TH_SYN if i == 0 else dpkt.tcp.TH_ACK | (dpkt.tcp.TH_PUSH if payload else 0)
+            l4 = dpkt.tcp.TCP(sport=sp, dport=dp, seq=seq[forward], ack=seq[not forward], flags=flags, win=65535,
+                              data=b'' if i == 0 else payload)
+            seq[forward] = (seq[forward] + max(len(l4.data), 1 if i == 0 else 0)) & 0xffffffff
+            proto = dpkt.ip.IP_PROTO_TCP
+        ip = dpkt.ip.IP(src=socket.inet_aton(src), dst=socket.inet_aton(dst), p=proto, ttl=64, data=l4)
+        ip.len = len(ip)
+        frame = dpkt.ethernet.Ethernet(src=b'\x00\x11\x22\x33\x44\x55', dst=b'\x66\x77\x88\x99\xaa\xbb',
+                                       type=dpkt.ethernet.ETH_TYPE_IP, data=ip)
+        frames.append((ts, bytes(frame)))
+        ts += float(rng.exponential(0.05))
+    return frames
+
+def feature_row(rng, sip, dip, sport, dport, udp, frames, label):
+    lengths = np.array([len(buf) for _, buf in frames])
+    duration = int((frames[-1][0] - frames[0][0]) * 1e6)
+    row = {
+        "Flow ID": f"{sip}-{dip}-{sport}-{dport}-{17 if udp else 6}",
+        "Src IP": sip, "Src Port": sport, "Dst IP": dip, "Dst Port": dport, "Protocol": 17 if udp else 6,
+        "Timestamp": "01/01/2024 00:00:00 AM", "Flow Duration": duration,
+    }
+    for col in CIC_FEATURE_COLUMNS:
+        row[col] = float(rng.choice(lengths)) * float(rng.random_sample()) if "Length" in col or "Size" in col \
+            else float(rng.exponential(1000))
+    row["Label"] = label
+    return row
+
+def generate_dataset(output, classes=4, flows=500, packets=10, min_payload=0, max_payload=1400, udp_ratio=0.1, seed=42):
+    """Write <output>/<class>.pcap raw captures and <output>/feature/<class>.pcap_Flow.csv, returns the capture paths
+
+    Flows of a capture overlap in time like real traffic; packets per flow follow
+    a Poisson law around packets, with at least one packet.
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(output, "feature"), exist_ok=True)
+    captures = []
+    for c in range(classes):
+        name = f"class{c}"
+        frames = []
+        rows = []
+        for f in range(flows):
+            sip = f"10.{c}.{f // 250 % 250}.{f % 250 + 1}"
+            dip = f"172.16.{int(rng.randint(0, 250))}.{int(rng.randint(1, 250))}"
+            sport = 1024 + f % 60000
+            dport = int(rng.choice([443, 80, 53, 8443, 993]))
+            udp = rng.random_sample() < udp_ratio
+            flow = flow_packets(rng, sip, dip, sport, dport, udp, max(int(rng.poisson(packets)), 1),
+                                min_payload, max_payload, 1700000000 + f * 0.01)
+            frames.extend(flow)
+            rows.append(feature_row(rng, sip, dip, sport, dport, udp, flow, name))
+        frames.sort(key=lambda frame: frame[0])
+
+        capture = os.path.join(output, name + ".pcap")
+        with open(capture, 'wb') as f:
+            dpkt.pcap.Writer(f).writepkts(frames)
+        with open(os.path.join(output, "feature", name + ".pcap_Flow.csv"), 'w', newline='', encoding='gbk') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        captures.append(capture)
+    return captures
+
+if __name__ == "__main__":
+    args = get_args()
+    captures = generate_dataset(args.output, args.classes, args.flows, args.packets, args.min_payload, args.max_payload,
+                                args.udp_ratio, args.seed)
+    print(f"generated {len(captures)} captures under {args.output}")
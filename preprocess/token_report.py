@@ -0,0 +1,58 @@
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+from transformers import AutoTokenizer
+from preprocess import chunk_pcap_dir, load_session_stats, process_shard
+from preprocess_utils import build_td_text_dataset
+
+def get_args():
+    parser = argparse.ArgumentParser(description="report tokens per flow of the verbose and compact flow formats")
+    parser.add_argument("--input", type=str, help="raw dataset path, with the flow/ and feature/ dirs", required=True)
+    parser.add_argument("--class_name", type=str, help="class directory under flow/, defaults to the first one", default=None)
+    parser.add_argument("--tokenizer", type=str, help="tokenizer name or path", required=True)
+    parser.add_argument("--task_name", type=str, help="detection task of the instruction", default="EAC")
+    parser.add_argument("--extractor", type=str, choices=["tshark", "native"], default="tshark", help="packet field extractor")
+    parser.add_argument("--max_flows", type=int, help="max number of flows rendered", default=1000)
+    parser.add_argument("--max_length", type=int, help="model max sequence length", default=512)
+    parser.add_argument("--output", type=str, help="json report path", default=None)
+    args = parser.parse_args()
+    return args
+
+def token_stats(tokenizer, texts, max_length):
+    lengths = np.array([len(ids) for ids in tokenizer(texts, add_special_tokens=True)["input_ids"]])
+    return {"mean": float(lengths.mean()), "median": float(np.median(lengths)),
+            "p95": float(np.percentile(lengths, 95)), "truncated": float((lengths > max_length).mean())}
+
+def main():
+    args = get_args()
+    flow_dir = os.path.join(args.input, "flow")
+    class_name = args.class_name or sorted(d for d in os.listdir(flow_dir) if os.path.isdir(os.path.join(flow_dir, d)))[0]
+    pcap_dir = os.path.join(flow_dir, class_name)
+    pcap_paths = sorted(p for chunk in chunk_pcap_dir(pcap_dir, 1) for p in chunk)[:args.max_flows]
+    session_stats = load_session_stats(pcap_dir)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    prefix = build_td_text_dataset([], task_name=args.task_name, granularity='session').attrs["instruction"]
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for flow_format in ["verbose", "compact"]:
+            flows, _, _, _, _ = process_shard(pcap_paths, args.input, session_stats, os.path.join(tmp, "shard.pcap"),
+                                           args.extractor, flow_format)
+            if not flows:
+                print(f"No flow of {class_name} passed the filter")
+                return
+            report[flow_format] = {"flows": len(flows),
+                                   "chars": float(np.mean([len(flow) for flow in flows])),
+                                   "tokens": token_stats(tokenizer, flows, args.max_length),
+                                   "tokens_with_instruction": token_stats(tokenizer, [prefix + flow for flow in flows], args.max_length)}
+            print(f"{flow_format}: {report[flow_format]}")
+
+    print(f"compact / verbose mean tokens: {report['compact']['tokens']['mean'] / report['verbose']['tokens']['mean']:.3f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import OrderedDict, Counter
+import numpy as np
+import torch
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocess"))
+from pcap_io import PcapRecordReader
+from packet_fields import FieldExtractor
+from pcap_to_flow import session_key, FLOW_IDLE_TIMEOUT, MAX_FLOW_TABLE_SIZE
+from flow_data_preprocess import render_flow, render_flow_compact, render_windows, MAX_PACKET_NUM
+from preprocess_utils import build_td_text_dataset
+from predict import FlowClassifier, read_label_names
+
+MIN_FLOW_PACKETS = 3  # flows closed by timeout with fewer packets are dropped, as in preprocess.filter_flow
+MAX_BATCH_WAIT_MS = 20
+
+def get_args():
+    parser = argparse.ArgumentParser(description="classify flows online from a replayed or piped packet stream")
+    parser.add_argument("--input", type=str, help="pcap file, or - to read a pcap stream from stdin", required=True)
+    parser.add_argument("--model_dir", type=str, help="saved model dir, only flows are rendered when not given", default=None)
+    parser.add_argument("--output", type=str, help="jsonl predictions path, stdout when not given", default=None)
+    parser.add_argument("--speed", type=float, help="replay speed relative to capture time, 0 replays as fast as possible", default=1.0)
+    parser.add_argument("--label_file", type=str, help="label.tsv written by preprocess.py", default=None)
+    parser.add_argument("--task_name", type=str, help="detection task of the instruction", default="EAC")
+    parser.add_argument("--no_instruction", action="store_true", help="the model was trained without the task instruction")
+    parser.add_argument("--flow_format", type=str, choices=["verbose", "compact"], default=None, help="flow serialization, defaults to the one the model was trained with, else verbose")
+    parser.add_argument("--max_packets", type=int, help="packets per flow before it is classified, defaults to the one the model was trained with, else 5", default=None)
+    parser.add_argument("--window_packets", type=int, help="packets per window, defaults to the one the model was trained with", default=None)
+    parser.add_argument("--min_packets", type=int, help="min packets of a flow closed by timeout", default=MIN_FLOW_PACKETS)
+    parser.add_argument("--idle_timeout", type=float, help="flow idle timeout in seconds", default=FLOW_IDLE_TIMEOUT)
+    parser.add_argument("--max_flows", type=int, help="flow table size", default=MAX_FLOW_TABLE_SIZE)
+    parser.add_argument("--max_length", type=int, help="max sequence length", default=512)
+    parser.add_argument("--batch_size", type=int, help="max flows per micro-batch", default=32)
+    parser.add_argument("--max_wait_ms", type=float, help="latency deadline of a micro-batch", default=MAX_BATCH_WAIT_MS)
+    parser.add_argument("--num_threads", type=int, help="intra-op threads", default=os.cpu_count())
+    args = parser.parse_args()
+    return args
+
+def open_packet_source(path, speed=1.0):
+    """Return (datalink, iterator of (ts, buf, wirelen)), paced at speed x capture time"""
+    f = sys.stdin.buffer if path == "-" else open(path, 'rb')
+    reader = PcapRecordReader(f)
+
+    def packets():
+        start_wall = time.perf_counter()
+        start_ts = None
+        try:
+            for ts, buf, wirelen in reader:
+                if speed and start_ts is not None:
+                    delay = (ts - start_ts) / speed - (time.perf_counter() - start_wall)
+                    if delay > 0:
+                        time.sleep(delay)
+                elif start_ts is None:
+                    start_ts = ts
+                yield ts, buf, wirelen
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+    return reader.datalink, packets()
+
+class FlowTable:
+    """Bidirectional 5-tuple sessions of a packet stream, named and evicted like pcap_to_flow.split_capture.
+
+    add() returns the flows that became ready: a flow is ready once it has
+    max_packets packets, or when it is closed by the idle timeout or a full
+    table with at least min_packets packets. Later packets of a ready flow are
+    only used to keep it open.
+    """
+
+    def __init__(self, datalink, max_packets=MAX_PACKET_NUM, min_packets=MIN_FLOW_PACKETS,
+                 idle_timeout=FLOW_IDLE_TIMEOUT, max_flows=MAX_FLOW_TABLE_SIZE, capture_name="stream"):
+        self.datalink = datalink
+        self.max_packets = max_packets
+        self.min_packets = min_packets
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.capture_name = capture_name
+        self.flows = OrderedDict()
+        self.names = Counter()
+        self.stats = Counter()
+
+    def _close(self, flow, ready):
+        if flow["packets"] is not None and len(flow["packets"]) >= self.min_packets:
+            self.stats["ready_timeout"] += 1
+            ready.append((flow["name"], flow["packets"], "timeout"))
+        elif flow["packets"] is not None:
+            self.stats["dropped_short"] += 1
+
+    def add(self, ts, buf, wirelen=None):
+        ready = []
+        self.stats["packets"] += 1
+        while self.flows:
+            oldest_key, oldest = next(iter(self.flows.items()))
+            if ts - oldest["last_ts"] <= self.idle_timeout and len(self.flows) < self.max_flows:
+                break
+            self._close(self.flows.pop(oldest_key), ready)
+
+        key, name = session_key(buf, self.datalink)
+        if key is None:
+            self.stats["skipped"] += 1
+            return ready
+        flow = self.flows.get(key)
+        if flow is None:
+            self.names[name] += 1
+            if self.names[name] > 1:
+                name = f"{name}_{self.names[name] - 1}"
+            flow = self.flows[key] = {"name": f"{self.capture_name}.{name}.pcap", "packets": []}
+            self.stats["flows"] += 1
+        else:
+            self.flows.move_to_end(key)
+        flow["last_ts"] = ts
+        if flow["packets"] is not None:
+            flow["packets"].append((ts, buf, wirelen))
+            if len(flow["packets"]) == self.max_packets:
+                self.stats["ready_packets"] += 1
+                ready.append((flow["name"], flow["packets"], "packets"))
+                flow["packets"] = None
+        return ready
+
+    def flush(self):
+        ready = []
+        while self.flows:
+            self._close(self.flows.popitem(last=False)[1], ready)
+        return ready
+
+def render_packets(packets, datalink, flow_format='verbose', feature="", window_packets=0):
+    """Render one flow with the build_flow_data serialization, dissected as if its session pcap were read alone"""
+    extractor = FieldExtractor(datalink)
+    flow = [extractor.extract(ts, buf, wirelen) for ts, buf, wirelen in packets]
+    render = render_flow_compact if flow_format == 'compact' else render_flow
+    if window_packets:
+        return render_windows(render, flow, feature, window_packets)
+    return render(flow, feature)
+
+class MicroBatcher:
+    """Inference queue run by a background thread.
+
+    A batch is dispatched once it holds batch_size flows or its oldest flow has
+    waited max_wait_ms, so a quiet stream still gets its flows classified in time.
+    """
+
+    def __init__(self, classifier, on_result, batch_size=32, max_wait_ms=MAX_BATCH_WAIT_MS):
+        self.classifier = classifier
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.latencies = []
+        self.batch_sizes = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, text, ready_time, reason):
+        self.queue.put((name, text, ready_time, reason))
+
+    def _run(self):
+        closed = False
+        while not closed:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[2] + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closed = True
+                    break
+                batch.append(item)
+            self._classify(batch)
+
+    def _classify(self, batch):
+        probs, _ = self.classifier.predict([text for _, text, _, _ in batch])
+        done = time.perf_counter()
+        self.batch_sizes.append(len(batch))
+        for (name, _, ready_time, reason), p in zip(batch, probs):
+            latency = (done - ready_time) * 1000
+            self.latencies.append(latency)
+            label_id = int(p.argmax())
+            self.on_result({"flow": name, "label": str(self.classifier.labels[label_id]), "label_id": label_id,
+                            "probs": [float(x) for x in p], "reason": reason, "latency_ms": latency})
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class StreamEngine:
+    """Flow table, serialization and micro-batched inference over one packet stream"""
+
+    def __init__(self, classifier=None, on_result=None, instruction="", flow_format='verbose', batch_size=32,
+                 max_wait_ms=MAX_BATCH_WAIT_MS, window_packets=0, **table_kwargs):
+        self.classifier = classifier
+        self.on_result = on_result or (lambda result: None)
+        self.instruction = instruction
+        self.flow_format = flow_format
+        self.window_packets = window_packets
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.table_kwargs = table_kwargs
+        self.table = None
+        self.batcher = None
+        self.rendered = {}
+        self.render_seconds = 0.0
+
+    def _emit(self, ready):
+        for name, packets, reason in ready:
+            ready_time = time.perf_counter()
+            text = self.instruction + render_packets(packets, self.table.datalink, self.flow_format, window_packets=self.window_packets)
+            self.render_seconds += time.perf_counter() - ready_time
+            if self.batcher is None:
+                self.rendered[name] = text
+                self.on_result({"flow": name, "reason": reason, "text": text})
+            else:
+                self.batcher.submit(name, text, ready_time, reason)
+
+    def run(self, datalink, packets):
+        self.table = FlowTable(datalink, **self.table_kwargs)
+        if self.classifier is not None:
+            self.batcher = MicroBatcher(self.classifier, self.on_result, self.batch_size, self.max_wait_ms)
+        start = time.perf_counter()
+        for ts, buf, wirelen in packets:
+            self._emit(self.table.add(ts, buf, wirelen))
+        self._emit(self.table.flush())
+        if self.batcher is not None:
+            self.batcher.close()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, seconds):
+        report = dict(self.table.stats)
+        report["seconds"] = seconds
+        report["packets_per_second"] = self.table.stats["packets"] / seconds if seconds else 0.0
+        classified = self.table.stats["ready_packets"] + self.table.stats["ready_timeout"]
+        report["render_ms_per_flow"] = self.render_seconds * 1000 / classified if classified else 0.0
+        if self.batcher is not None and self.batcher.latencies:
+            report["flows_per_second"] = len(self.batcher.latencies) / seconds
+            report["mean_batch_size"] = float(np.mean(self.batcher.batch_sizes))
+            report["latency_ms"] = {p: float(np.percentile(self.batcher.latencies, int(p[1:]))) for p in ["p50", "p95", "p99"]}
+        return report
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.num_threads)
+
+    classifier = None
+    if args.model_dir:
+        labels = read_label_names(args.label_file) if args.label_file else None
+        classifier = FlowClassifier(args.model_dir, args.max_length, args.batch_size, labels=labels)
+    instruction = ""
+    if not args.no_instruction:
+        instruction = build_td_text_dataset([], task_name=args.task_name, granularity='session').attrs["instruction"]
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    lock = threading.Lock()
+
+    def on_result(result):
+        with lock:
+            output.write(json.dumps(result) + "\n")
+
+    # the model gets flows rendered as in its training set
+    max_packets = args.max_packets or (classifier is not None and classifier.max_packets) or MAX_PACKET_NUM
+    window_packets = args.window_packets if args.window_packets is not None else (classifier is not None and classifier.window_packets) or 0
+    flow_format = args.flow_format or (classifier is not None and classifier.flow_format) or "verbose"
+
+    capture_name = "stream" if args.input == "-" else os.path.basename(args.input)
+    engine = StreamEngine(classifier, on_result, instruction, flow_format, args.batch_size, args.max_wait_ms, window_packets,
+                          max_packets=max_packets, min_packets=args.min_packets, idle_timeout=args.idle_timeout,
+                          max_flows=args.max_flows, capture_name=capture_name)
+    report = engine.run(*open_packet_source(args.input, args.speed))
+    if output is not sys.stdout:
+        output.close()
+    print(f"stream report: {report}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+from stream_classify import StreamEngine, open_packet_source, MIN_FLOW_PACKETS
+from pcap_to_flow import split_capture
+from pcap_io import count_records
+from packet_fields import iter_flow_fields
+from flow_data_preprocess import render_flow, render_flow_compact, MAX_PACKET_NUM
+from predict import FlowClassifier
+
+def get_args():
+    parser = argparse.ArgumentParser(description="replay a pcap through the streaming engine and check it against the offline pipeline")
+    parser.add_argument("--pcap", type=str, help="capture to replay", required=True)
+    parser.add_argument("--model_dir", type=str, help="saved model dir, also checks the streamed predictions", default=None)
+    parser.add_argument("--speed", type=float, help="replay speed relative to capture time, 0 replays as fast as possible", default=0)
+    parser.add_argument("--flow_format", type=str, choices=["verbose", "compact"], default="verbose", help="flow serialization")
+    parser.add_argument("--max_packets", type=int, help="packets per flow before it is classified", default=MAX_PACKET_NUM)
+    parser.add_argument("--batch_size", type=int, help="max flows per micro-batch", default=32)
+    parser.add_argument("--max_wait_ms", type=float, help="latency deadline of a micro-batch", default=20)
+    parser.add_argument("--output", type=str, help="json report path", default=None)
+    args = parser.parse_args()
+    return args
+
+def offline_flows(pcap, max_packets, flow_format):
+    """Split pcap with pcap_to_flow and render each session pcap on its own"""
+    render = render_flow_compact if flow_format == 'compact' else render_flow
+    flows = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        split_capture(pcap, tmp, max_packets)
+        for session in sorted(Path(tmp).glob('*.pcap')):
+            pnum = count_records(str(session), limit=max_packets)
+            if pnum < MIN_FLOW_PACKETS:
+                continue
+            flows[session.name] = render(next(iter_flow_fields(str(session), [pnum])), "")
+    return flows
+
+def main():
+    args = get_args()
+    report = {}
+
+    # rendering parity: the streamed flows must be the sessions pcap_to_flow writes, serialized identically
+    streamed = StreamEngine(flow_format=args.flow_format, max_packets=args.max_packets,
+                            capture_name=os.path.basename(args.pcap))
+    report["engine"] = streamed.run(*open_packet_source(args.pcap, args.speed))
+    expected = offline_flows(args.pcap, args.max_packets, args.flow_format)
+    mismatched = [name for name in expected.keys() & streamed.rendered.keys() if expected[name] != streamed.rendered[name]]
+    report["parity"] = {
+        "offline_flows": len(expected),
+        "streamed_flows": len(streamed.rendered),
+        "missing": sorted(expected.keys() - streamed.rendered.keys())[:10],
+        "unexpected": sorted(streamed.rendered.keys() - expected.keys())[:10],
+        "mismatched": sorted(mismatched)[:10],
+    }
+    ok = not (report["parity"]["missing"] or report["parity"]["unexpected"] or mismatched)
+
+    if args.model_dir:
+        # prediction parity: micro-batched streaming results must match one offline predict() call
+        classifier = FlowClassifier(args.model_dir, batch_size=args.batch_size)
+        results = {}
+        engine = StreamEngine(classifier, lambda result: results.__setitem__(result["flow"], result), "",
+                              args.flow_format, args.batch_size, args.max_wait_ms, max_packets=args.max_packets,
+                              capture_name=os.path.basename(args.pcap))
+        report["inference"] = engine.run(*open_packet_source(args.pcap, args.speed))
+        names = sorted(results)
+        probs, _ = classifier.predict([streamed.rendered[name] for name in names])
+        max_diff = float(np.abs(probs - np.array([results[name]["probs"] for name in names])).max()) if names else 0.0
+        report["inference"]["max_prob_diff"] = max_diff
+        ok = ok and len(names) == len(streamed.rendered) and max_diff < 1e-4
+
+    report["ok"] = ok
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
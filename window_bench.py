@@ -0,0 +1,109 @@
+import os
+import time
+import json
+import argparse
+import resource
+import torch
+from transformers import AutoConfig, AutoModel
+from main import WindowPoolingModel
+
+MODES = ["truncate", "full", "window"]
+
+def get_args():
+    parser = argparse.ArgumentParser(description="benchmark CPU inference of windowed long flows against plain truncation")
+    parser.add_argument("--model_name", type=str, help="pretrained model name or path, only its config is used", required=True)
+    parser.add_argument("--packets", type=int, nargs="+", help="packets per flow", default=[5, 10, 20, 50, 100, 200])
+    parser.add_argument("--tokens_per_packet", type=int, help="tokens of one rendered packet, see preprocess/token_report.py", default=64)
+    parser.add_argument("--window_packets", type=int, help="packets per window", default=5)
+    parser.add_argument("--max_length", type=int, help="max sequence length of the truncate mode and of a window", default=512)
+    parser.add_argument("--pooling", type=str, choices=["mean", "attention"], default="mean", help="window pooling")
+    parser.add_argument("--window_batch", type=int, help="windows encoded at once", default=32)
+    parser.add_argument("--batch_size", type=int, help="flows per batch", default=8)
+    parser.add_argument("--num_batches", type=int, help="timed batches per configuration", default=3)
+    parser.add_argument("--modes", type=str, nargs="+", choices=MODES, default=MODES,
+                        help="full encodes the whole flow as one sequence, skipped past the model's max positions")
+    parser.add_argument("--num_threads", type=int, help="intra-op threads", default=os.cpu_count())
+    parser.add_argument("--output", type=str, help="json results path", default=None)
+    args = parser.parse_args()
+    return args
+
+def reset_peak_rss():
+    # Linux only: resets VmHWM of this process, so every configuration reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def rss_mb(field="VmHWM:"):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def sequence_shape(mode, packets, args):
+    """(sequences per flow, tokens per sequence) of a flow, with the [CLS] and [SEP] tokens"""
+    tokens = packets * args.tokens_per_packet + 2
+    if mode == "truncate":
+        return 1, min(tokens, args.max_length)
+    if mode == "full":
+        return 1, tokens
+    windows = -(-packets // args.window_packets)
+    return windows, min(args.window_packets * args.tokens_per_packet + 2, args.max_length)
+
+def make_batch(vocab_size, flows, sequences, length, generator):
+    input_ids = torch.randint(min(1000, vocab_size // 2), vocab_size, (flows * sequences, length), generator=generator)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids),
+            "flow_index": torch.arange(flows).repeat_interleave(sequences)}
+
+def run_config(model, mode, packets, args):
+    sequences, length = sequence_shape(mode, packets, args)
+    if length > model.config.max_position_embeddings:
+        return None
+    # single sequence modes encode the whole batch at once, as a plain classifier would
+    model.window_batch = args.window_batch if mode == "window" else args.batch_size
+    batch = make_batch(model.config.vocab_size, args.batch_size, sequences, length, torch.Generator().manual_seed(packets))
+    with torch.inference_mode():
+        model(**batch)
+        rss_before = rss_mb("VmRSS:")
+        reset_peak_rss()
+        start = time.perf_counter()
+        for _ in range(args.num_batches):
+            model(**batch)
+        seconds = time.perf_counter() - start
+    return {
+        "sequences_per_flow": sequences, "tokens_per_sequence": length,
+        "tokens_encoded": min(packets * args.tokens_per_packet, sequences * (length - 2)),
+        "ms_per_flow": seconds * 1000 / (args.num_batches * args.batch_size),
+        "peak_rss_mb": rss_mb(),
+        "activation_mb": max(rss_mb() - rss_before, 0.0),
+    }
+
+def main():
+    args = get_args()
+    torch.set_num_threads(args.num_threads)
+    encoder = AutoModel.from_config(AutoConfig.from_pretrained(args.model_name))
+    model = WindowPoolingModel(encoder, 2, args.pooling, args.window_batch).eval()
+
+    results = {}
+    for packets in args.packets:
+        results[packets] = {}
+        for mode in [m for m in MODES if m in args.modes]:
+            results[packets][mode] = run_config(model, mode, packets, args)
+            print(f"{packets} packets, {mode}: {results[packets][mode] or 'skipped, longer than the max positions'}")
+
+    report = {
+        "params": {k: getattr(args, k) for k in ["model_name", "tokens_per_packet", "window_packets", "max_length",
+                                                 "pooling", "window_batch", "batch_size", "num_batches", "num_threads"]},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()